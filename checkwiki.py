@@ -1,12 +1,29 @@
 #!/usr/bin/python
+import glob
+import heapq
+import json
+import multiprocessing
+import os
 import re
+import threading
+import time
+
+from collections import OrderedDict, defaultdict, deque
 
 import pywikibot
+import requests
 
-from pywikibot import pagegenerators
+from pywikibot import config, pagegenerators
 from pywikibot.exceptions import UnknownExtension
+from pywikibot.tools.itertools import itergroup
 
 from checkwiki_errors import *
+from tools import (
+    LiteralMatcher,
+    fold_case,
+    iter_dump_pages,
+    required_literals,
+)
 from wikitext import WikitextFixingBot
 
 
@@ -89,19 +106,400 @@ class CheckWikiSettings:
 
 class CheckWikiErrorGenerator:
 
+    '''
+    Generator of pages listed under any of the selected errors
+
+    Lists of the errors are read in turns. Pages wait in a window for
+    some time to collect all errors they are listed under, these are
+    then available for the bot in CheckWiki.listed. Until the bot treats
+    or skips the page, it is not yielded again.
+    '''
+
+    window = 500
+
     def __init__(self, checkwiki, priorities=None, ids=None):
         self.checkwiki = checkwiki
         self.priorities = priorities or []
         self.ids = ids or []
 
-    def __iter__(self):
+    def iter_numbers(self):
+        already = set()
         for error in self.ids:
-            yield from self.checkwiki.iter_pages(error)
-        already = set(self.ids)
+            if error not in already:
+                already.add(error)
+                yield error
         for prio in self.priorities:
             for error in self.checkwiki.settings.get_errors_by_priority(prio):
                 if error not in already:
-                    yield from self.checkwiki.iter_pages(error)
+                    already.add(error)
+                    yield error
+
+    def iter_listed(self):
+        streams = deque(
+            (error, iter(self.checkwiki.iter_titles(error)))
+            for error in self.iter_numbers())
+        while streams:
+            error, titles = streams.popleft()
+            title = next(titles, None)
+            if title is not None:
+                streams.append((error, titles))
+                yield title, error
+
+    def __iter__(self):
+        listed = self.checkwiki.listed
+        waiting = OrderedDict()
+        for title, error in self.iter_listed():
+            if title in waiting:
+                waiting[title].add(error)
+                continue
+            # released pages are kept only until the bot takes them
+            page = pywikibot.Page(self.checkwiki.site, title)
+            if page.title() in listed:
+                listed[page.title()].add(error)
+                continue
+            waiting[title] = {error}
+            if len(waiting) > self.window:
+                yield self.release(*waiting.popitem(last=False))
+        while waiting:
+            yield self.release(*waiting.popitem(last=False))
+
+    def release(self, title, errors):
+        page = pywikibot.Page(self.checkwiki.site, title)
+        self.checkwiki.listed[page.title()] = errors
+        return page
+
+
+class CheckWikiDetector:
+
+    '''
+    Class telling which CheckWiki errors are present in a text
+
+    Errors are indexed by literals required by their patterns, so that
+    the text is scanned only once to find candidates whose patterns
+    are then searched. Errors which cannot be told by a pattern are
+    always reported as present.
+    '''
+
+    def __init__(self, errors):
+        self.always = set()
+        self.unindexed = set()
+        self.patterns = {}
+        self.literals = {}
+        owners = {}
+        for error in errors:
+            regex = error.detection_pattern()
+            if regex is None:
+                self.always.add(error.number)
+                continue
+            self.patterns[error.number] = regex
+            literals = required_literals(regex)
+            self.literals[error.number] = literals
+            if not literals:
+                self.unindexed.add(error.number)
+                continue
+            for literal in literals:
+                owners.setdefault(literal, []).append(error.number)
+        self.owners = list(owners.values())
+        self.matcher = LiteralMatcher(owners.keys())
+
+    def present(self, text):
+        '''Return numbers of errors which are present in the text.'''
+        found = set(self.always)
+        candidates = set(self.unindexed)
+        for index in self.matcher.search(fold_case(text)):
+            candidates.update(self.owners[index])
+        for number in candidates:
+            if self.patterns[number].search(text):
+                found.add(number)
+        return found
+
+    def has_error(self, text, number):
+        '''Return whether the error can be present in the text.'''
+        if number not in self.patterns:
+            return number in self.always
+        literals = self.literals[number]
+        if literals:
+            folded = fold_case(text)
+            if not any(literal in folded for literal in literals):
+                return False
+        return bool(self.patterns[number].search(text))
+
+
+_scanner = {}
+
+
+def _init_scanner(sitename):
+    # forked workers inherit the detector
+    if 'detector' not in _scanner:
+        _scanner['detector'] = CheckWiki(pywikibot.Site(*sitename)).detector
+
+
+def _scan_chunk(chunk):
+    detector = _scanner['detector']
+    return [(title, sorted(detector.present(text) - detector.always))
+            for title, text in chunk]
+
+
+class CheckWikiIndex:
+
+    '''
+    Local lists of pages with CheckWiki errors
+
+    Lists are built by scanning a dump and kept up to date from newer
+    dumps or recent changes. Only errors told by their patterns are
+    listed.
+    '''
+
+    def __init__(self, site, detector):
+        self.site = site
+        self.detector = detector
+        self.timestamp = None
+        self.errors = defaultdict(set)
+
+    @property
+    def path(self):
+        return config.datafilepath('checkwiki', f'{self.site.dbName()}.json')
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self
+        self.timestamp = data.get('timestamp')
+        for number, titles in data.get('errors', {}).items():
+            self.errors[int(number)] = set(titles)
+        return self
+
+    def save(self):
+        data = {
+            'timestamp': self.timestamp,
+            'errors': {number: sorted(titles)
+                       for number, titles in self.errors.items() if titles},
+        }
+        path = self.path
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def titles(self, number):
+        return sorted(self.errors.get(number, ()))
+
+    def discard(self, title, number):
+        self.errors[number].discard(title)
+
+    def update(self, title, numbers):
+        for titles in self.errors.values():
+            titles.discard(title)
+        for number in numbers:
+            self.errors[number].add(title)
+
+    def scan_dump(self, filename, workers=0, chunksize=100):
+        '''Scan pages changed since the last scan and forget missing ones.'''
+        seen = set()
+        newest = self.timestamp
+
+        def changed_entries():
+            nonlocal newest
+            for entry in iter_dump_pages(filename, namespaces=[0]):
+                seen.add(entry.title)
+                timestamp = str(entry.timestamp or '')
+                if (self.timestamp and timestamp
+                        and timestamp <= self.timestamp):
+                    continue
+                if timestamp and (newest is None or timestamp > newest):
+                    newest = timestamp
+                yield entry.title, entry.text
+
+        _scanner['detector'] = self.detector
+        workers = workers or os.cpu_count()
+        pending = deque()
+        sitename = (self.site.code, self.site.family.name)
+        with multiprocessing.Pool(
+                workers, _init_scanner, (sitename,)) as pool:
+            for chunk in itergroup(changed_entries(), chunksize):
+                pending.append(pool.apply_async(_scan_chunk, (chunk,)))
+                while len(pending) >= 2 * workers:
+                    self._merge(pending.popleft().get())
+            while pending:
+                self._merge(pending.popleft().get())
+
+        for titles in self.errors.values():
+            titles &= seen
+        self.timestamp = newest
+
+    def _merge(self, results):
+        for title, numbers in results:
+            self.update(title, numbers)
+
+    def scan_recentchanges(self):
+        '''Scan pages edited since the last scan.'''
+        if not self.timestamp:
+            pywikibot.warning('Scan a dump first')
+            return
+        start = self.site.server_time()
+        changes = self.site.recentchanges(
+            start=pywikibot.Timestamp.fromISOformat(self.timestamp),
+            reverse=True, namespaces=[0], top_only=True)
+        titles = {change['title'] for change in changes
+                  if change['type'] in ('edit', 'new')}
+        pywikibot.info(f'Scanning {len(titles)} recently changed pages')
+        pages = pagegenerators.PreloadingGenerator(
+            pywikibot.Page(self.site, title) for title in titles)
+        for page in pages:
+            if not page.exists() or page.isRedirectPage():
+                self.update(page.title(), [])
+                continue
+            present = self.detector.present(page.text)
+            self.update(page.title(), present - self.detector.always)
+        self.timestamp = start.isoformat()
+
+
+class CheckWikiReporter(threading.Thread):
+
+    '''
+    Thread marking errors as fixed in the background
+
+    Marks wait in a file until they are sent, so that they are sent
+    on the next run when the bot or the server fails. Marks for the same
+    page are sent together, failed requests are retried later.
+
+    Only this thread writes the file and it uses its own session,
+    the bot only adds marks. Each process has its own file and takes
+    over files of other runs when it starts.
+    '''
+
+    min_delay = 5  # seconds
+    max_delay = 600
+    timeout = 30
+
+    def __init__(self, checkwiki):
+        super().__init__(name='CheckWikiReporter', daemon=True)
+        self.checkwiki = checkwiki
+        self.prefix = config.datafilepath(
+            'checkwiki', f'{checkwiki.site.dbName()}-marks')
+        self.path = f'{self.prefix}-{os.getpid()}.json'
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.delay = None
+        self.retry = 0
+        self.pending = {}
+        self.changed = False
+        self.session = requests.Session()
+        self.load()
+
+    def load(self):
+        # a run which is still going writes its file again on the next
+        # change, so its marks are sent twice at worst
+        claimed = []
+        paths = glob.glob(glob.escape(self.prefix) + '*.json')
+        for i, path in enumerate(paths):
+            claim = f'{self.path}.{i}.claimed'
+            try:
+                os.replace(path, claim)
+            except OSError:
+                continue
+            claimed.append(claim)
+            try:
+                with open(claim, encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for project, title, errors in data:
+                key = (project, title)
+                self.pending.setdefault(key, set()).update(errors)
+        if self.pending:
+            pywikibot.info(f'{len(self.pending)} pages left to be marked '
+                           'as fixed from other runs')
+            self.changed = True
+            self.save()
+            self.wakeup.set()
+        for claim in claimed:
+            os.remove(claim)
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            data = [[project, title, sorted(errors)]
+                    for (project, title), errors in self.pending.items()]
+            self.changed = False
+        if not data:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(self.path + '.tmp', self.path)
+
+    def add(self, page, errors):
+        if not errors:
+            return
+        key = (page.site.dbName(), page.title())
+        with self.lock:
+            self.pending.setdefault(key, set()).update(errors)
+            self.changed = True
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            while True:
+                timeout = None
+                if self.delay is not None:
+                    timeout = max(0, self.retry - time.monotonic())
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+                # do not retry before the delay, only save new marks
+                if self.delay is None or self.stopping \
+                   or time.monotonic() >= self.retry:
+                    self.send()
+                self.save()
+                if self.stopping:
+                    break
+        finally:
+            self.session.close()
+
+    def send(self):
+        if self.send_pending():
+            self.delay = None
+            return
+        if self.delay is None:
+            self.delay = self.min_delay
+        else:
+            self.delay = min(2 * self.delay, self.max_delay)
+        self.retry = time.monotonic() + self.delay
+
+    def send_pending(self):
+        with self.lock:
+            items = [(key, sorted(errors))
+                     for key, errors in self.pending.items()]
+        for (project, title), errors in items:
+            try:
+                for error in errors:
+                    data = self.checkwiki.mark_data(project, title, error)
+                    response = self.session.post(
+                        self.checkwiki.url, data, timeout=self.timeout)
+                    response.raise_for_status()
+                    with self.lock:
+                        self.pending[project, title].discard(error)
+            except requests.RequestException as exc:
+                pywikibot.warning(f'Failed to mark {title} as fixed: {exc}')
+                return False
+            finally:
+                with self.lock:
+                    if not self.pending[project, title]:
+                        del self.pending[project, title]
+                    self.changed = True
+        return True
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.join()
+        if self.pending:
+            pywikibot.warning(f'{len(self.pending)} pages will be marked '
+                              'as fixed on the next run')
 
 
 class CheckWiki:
@@ -155,12 +553,21 @@ class CheckWiki:
         103: SuperfluousPipe,
         104: ReferenceQuotes,
     }
+    # how many times errors can be rerun after other errors changed the text
+    max_rounds = 3
 
     def __init__(self, site):
+        self.timings = defaultdict(float)
+        self.index = None
+        self.listed = {}
+        self.reporter = None
+        self.session = requests.Session()
         self.site = site
 
     def purge(self):
         self.__cache = {}
+        self._detector = None
+        self._schedule = None
 
     @property
     def site(self):
@@ -182,6 +589,48 @@ class CheckWiki:
             self.load_settings()
         return self._settings
 
+    @property
+    def detector(self):
+        if self._detector is None:
+            self._detector = CheckWikiDetector(self.iter_errors())
+        return self._detector
+
+    @property
+    def schedule(self):
+        '''Numbers of errors, each after errors in its needsFirst.'''
+        if self._schedule is None:
+            self._schedule = self.topological_order()
+        return self._schedule
+
+    def topological_order(self):
+        numbers = set(self.errorMap)
+        dependants = {num: [] for num in numbers}
+        missing = {}
+        for num in numbers:
+            required = [first for first in self.errorMap[num].needsFirst
+                        if first in numbers]
+            missing[num] = len(required)
+            for first in required:
+                dependants[first].append(num)
+
+        # lower numbers go first if there is a choice
+        heap = [num for num, count in missing.items() if count == 0]
+        heapq.heapify(heap)
+        order = []
+        while heap:
+            num = heapq.heappop(heap)
+            order.append(num)
+            for dependant in dependants[num]:
+                missing[dependant] -= 1
+                if missing[dependant] == 0:
+                    heapq.heappush(heap, dependant)
+
+        if len(order) < len(numbers):
+            cycle = sorted(numbers - set(order))
+            pywikibot.warning(f'Errors {cycle} need each other first')
+            order.extend(cycle)
+        return order
+
     def get_error(self, number):
         return self.__cache.setdefault(number, self.errorMap[number](self))
 
@@ -199,31 +648,60 @@ class CheckWiki:
             yield error
 
     def apply(self, text, page, replaced=[], fixed=[], errors=[], **kwargs):
-        # todo: use a graph algorithm
-        errors = list(self.iter_errors(set(errors)))
-        while errors:
-            error = errors.pop(0)
-            if error.needsDecision() or error.handledByCC():  # todo
+        selected = set(errors)
+        errors = []
+        for num in self.schedule:
+            if selected and num not in selected:
                 continue
-
-            numbers = [err.number for err in errors]
-            i = max([numbers.index(num) for num in error.needsFirst
-                     if num in numbers] + [0])
-            if i > 0:
-                errors.insert(i, error)
+            error = self.get_error(num)
+            if error.needsDecision() or error.handledByCC():  # todo
                 continue
-
-            new_text = error.apply(text, page)
-            if new_text != text:
-                text = new_text
-                summary = error.summary
-                fixed.append(error.number)
-                if summary not in replaced:
-                    replaced.append(summary)
+            errors.append(error)
+
+        present = self.detector.present(text)
+        version = 0
+        # version of the text each error was last applied to
+        applied_to = {}
+        for _ in range(self.max_rounds):
+            changed = False
+            for error in errors:
+                if applied_to.get(error.number) == version:
+                    continue  # nothing changed since
+                applied_to[error.number] = version
+                if error.number not in present:
+                    continue
+
+                start = time.perf_counter()
+                new_text = error.apply(text, page)
+                self.timings[error.number] += time.perf_counter() - start
+                if new_text != text:
+                    text = new_text
+                    changed = True
+                    version += 1
+                    applied_to[error.number] = version
+                    present = self.detector.present(text)
+                    summary = error.summary
+                    if error.number not in fixed:
+                        fixed.append(error.number)
+                    if summary not in replaced:
+                        replaced.append(summary)
+            if not changed:
+                break
 
         return text
 
+    def report_timings(self, limit=10):
+        timings = sorted(self.timings.items(), key=lambda item: item[1],
+                         reverse=True)
+        pywikibot.info('\nSlowest CheckWiki errors:')
+        for number, seconds in timings[:limit]:
+            pywikibot.info(f'{number}: {seconds:.2f}s')
+
     def iter_titles(self, num, **kwargs):
+        if self.index is not None:
+            yield from self.index.titles(num)
+            return
+
         data = {
             'action': 'list',
             'id': num,
@@ -237,23 +715,46 @@ class CheckWiki:
             yield pywikibot.Page(self.site, title)
 
     def get(self, data, **kwargs):
-        return requests.get(self.url, data, **kwargs)
+        return self.session.get(self.url, params=data, **kwargs)
 
     def post(self, data, **kwargs):
-        return requests.post(self.url, data, **kwargs)
+        return self.session.post(self.url, data, **kwargs)
 
-    def mark_as_fixed(self, page, error):
-        data = {
+    @staticmethod
+    def mark_data(project, title, error):
+        return {
             'action': 'mark',
             'id': error,
-            'project': page.site.dbName(),
-            'title': page.title(),
+            'project': project,
+            'title': title,
         }
+
+    def mark_as_fixed(self, page, error):
+        if self.index is not None:
+            self.index.discard(page.title(), error)
+        data = self.mark_data(page.site.dbName(), page.title(), error)
         return self.post(data)
 
     def mark_as_fixed_multiple(self, page, errors):
-        for error in errors:
-            self.mark_as_fixed(page, error)
+        if self.reporter is None:
+            for error in errors:
+                self.mark_as_fixed(page, error)
+            return
+
+        if self.index is not None:
+            for error in errors:
+                self.index.discard(page.title(), error)
+        self.reporter.add(page, errors)
+
+    def start_reporter(self):
+        if self.reporter is None:
+            self.reporter = CheckWikiReporter(self)
+            self.reporter.start()
+
+    def stop_reporter(self):
+        if self.reporter is not None:
+            self.reporter.stop()
+            self.reporter = None
 
     @staticmethod
     def parse_option(option):
@@ -279,18 +780,51 @@ class CheckWikiBot(WikitextFixingBot):
         page = self.current_page
         replaced = []
         fixed = []
+        numbers = self.numbers
+        listed = self.checkwiki.listed.pop(page.title(), None)
+        if listed and numbers:
+            numbers = sorted(listed.union(numbers))
         text = self.checkwiki.apply(
-            page.text, page, replaced, fixed, self.numbers)
+            page.text, page, replaced, fixed, numbers)
+        if listed and self.checkwiki.index is not None:
+            self.forget_not_found(page, listed.difference(fixed))
         summary = 'opravy dle [[WP:WCW|CheckWiki]]: %s' % ', '.join(replaced)
         self.put_current(
             text, summary=summary,
             callback=lambda *args: self.mark_as_fixed_on_success(fixed, *args))
 
+    def skip_page(self, page):
+        if super().skip_page(page):
+            self.checkwiki.listed.pop(page.title(), None)
+            return True
+        return False
+
+    def forget_not_found(self, page, numbers):
+        # the index does not know exceptions of the errors, so it lists
+        # pages where the fixes find nothing
+        for number in numbers:
+            error = self.checkwiki.get_error(number)
+            if not (error.needsDecision() or error.handledByCC()):
+                self.checkwiki.index.discard(page.title(), number)
+
     def mark_as_fixed_on_success(self, numbers, page, exc=None):
         if exc is not None:
             return
         self.checkwiki.mark_as_fixed_multiple(page, numbers)
 
+    def setup(self):
+        super().setup()
+        self.checkwiki.start_reporter()
+
+    def teardown(self):
+        self.checkwiki.report_timings()
+        if self.checkwiki.index is not None:
+            self.checkwiki.index.save()
+        try:
+            super().teardown()
+        finally:
+            self.checkwiki.stop_reporter()
+
 
 def main(*args):
     options = {}
@@ -299,13 +833,22 @@ def main(*args):
     checkwiki = CheckWiki(site)
     genFactory = pagegenerators.GeneratorFactory(site=site)
     numbers = []
-    gens = []
+    ids = []
+    priorities = []
+    use_index = False
+    dump = None
     for arg in genFactory.handle_args(local_args):
+        if arg == '-index':
+            use_index = True
+            continue
+        if arg.startswith('-scandump:'):
+            dump = arg.partition(':')[2]
+            continue
         if arg.startswith('-checkwiki:'):
-            ids, priorities = checkwiki.parse_option(arg.partition(':')[2])
-            gen = CheckWikiErrorGenerator(
-                checkwiki, ids=ids, priorities=priorities)
-            gens.append(gen)
+            new_ids, new_priorities = checkwiki.parse_option(
+                arg.partition(':')[2])
+            ids.extend(new_ids)
+            priorities.extend(new_priorities)
             continue
         if arg.startswith('-'):
             arg, sep, value = arg.partition(':')
@@ -315,9 +858,22 @@ def main(*args):
                 options[arg[1:]] = True
         else:
             numbers.extend(checkwiki.parse_option(arg)[0])
+    workers = options.pop('workers', 0)
 
-    if gens:
-        genFactory.gens.extend(gens)
+    if use_index or dump:
+        # local lists instead of those of the CheckWiki tool
+        index = CheckWikiIndex(site, checkwiki.detector).load()
+        if dump:
+            index.scan_dump(dump, workers=workers)
+        else:
+            index.scan_recentchanges()
+        index.save()
+        checkwiki.index = index
+
+    if ids or priorities:
+        # one generator so that pages listed more times are fixed at once
+        genFactory.gens.append(CheckWikiErrorGenerator(
+            checkwiki, ids=ids, priorities=priorities))
     generator = genFactory.getCombinedGenerator(preload=True)
     if not generator:
         genFactory.gens.append(CheckWikiErrorGenerator(checkwiki, ids=numbers))
@@ -5,7 +5,7 @@ import pywikibot
 
 from pywikibot import textlib
 
-from tools import deduplicate
+from tools import deduplicate, replace_except, RegexRegistry
 
 
 class CheckWikiError:
@@ -15,6 +15,9 @@ class CheckWikiError:
     exceptions = ['ce', 'comment', 'graph', 'hiero', 'math', 'nowiki', 'pre',
                   'score', 'startspace', 'syntaxhighlight']
     needsFirst = []
+    # whether the pattern must match for apply to change anything,
+    # None means only when apply is not overridden
+    pattern_required = None
 
     def __init__(self, checkwiki):
         self.checkwiki = checkwiki
@@ -27,16 +30,30 @@ class CheckWikiError:
     def settings(self):
         return self.checkwiki.settings
 
+    def get_pattern(self):
+        '''Return pattern() compiled only once for the site.'''
+        return RegexRegistry.get(
+            self.site, f'checkwiki-{type(self).__name__}', self.pattern)
+
+    def detection_pattern(self):
+        '''Return pattern() when it tells whether the error is present.'''
+        required = self.pattern_required
+        if required is None:
+            required = type(self).apply is CheckWikiError.apply
+        if required and hasattr(self, 'pattern'):
+            return self.get_pattern()
+        return None
+
     def apply(self, text, page):
-        return textlib.replaceExcept(text, self.pattern(), self.replacement,
-                                     self.exceptions, site=page.site)
+        return replace_except(text, self.get_pattern(), self.replacement,
+                              self.exceptions, site=page.site)
 
     def isForFixes(self):  # todo: per subclass
         return hasattr(self, 'pattern') and hasattr(self, 'replacement')
 
     def toTuple(self):
         assert self.isForFixes()
-        return (self.pattern().pattern, self.replacement)
+        return (self.get_pattern().pattern, self.replacement)
 
     def needsDecision(self):  # todo: per subclass, user_interactor
         return False
@@ -173,10 +190,11 @@ class LowHeadersLevel(HeaderError):
 
     number = 7
     needsFirst = [8]
+    pattern_required = True
     summary = 'oprava úrovní nadpisů'
 
     def apply(self, text, page):
-        regex = self.pattern()
+        regex = self.get_pattern()
         min_level = 8
         for match in regex.finditer(text):
             start, end = match.group('start', 'end')
@@ -452,10 +470,11 @@ class HeaderHierarchy(HeaderError):
 
     needsFirst = [8]
     number = 25
+    pattern_required = True
     summary = 'oprava úrovně nadpisu'
 
     def apply(self, text, page):
-        regex = self.pattern()
+        regex = self.get_pattern()
         levels = []
         for match in regex.finditer(text):
             level = len(match['start'])
@@ -625,7 +644,7 @@ class SelfLink(CheckWikiError):
         exceptions = list(set(self.exceptions + [
             'imagemap', 'includeonly', 'timeline']) - {'startspace'})
         title = page.title()
-        return textlib.replaceExcept(
+        return replace_except(
             text, r"(?P<before>''')?\[\[(?P<inside>[^]]+)\]\](?P<after>''')?",
             lambda m: self.replacement(m, title), exceptions, site=page.site)
 
@@ -866,7 +885,7 @@ class BadListStructure(CheckWikiError):  # todo
     def apply(self, text, page):
         levels = ['']
         regex = re.compile('^.*$', re.M)
-        return textlib.replaceExcept(
+        return replace_except(
             text, regex, lambda match: self.replace(match, levels),
             self.exceptions[:], site=self.site)
 
@@ -8,6 +8,7 @@ from pywikibot import i18n, pagegenerators, textlib
 from pywikibot.exceptions import UnknownExtensionError
 
 from deferred import DeferredCallbacksBot
+from tools import WikitextDocument
 from wikidata import WikidataEntityBot
 from wikitext import WikitextFixingBot
 
@@ -47,13 +48,14 @@ class CommonscatCleaningBot(WikitextFixingBot, WikidataEntityBot, DeferredCallba
         page = self.current_page
         item = page.data_item()
         if 'P373' in item.claims:
-            self.addCallback(page.touch)
+            self.addTouch(page)
             pywikibot.info('Already has a category on Commons')
             return
 
         cat_name = None
         has_param = False
-        for template, fielddict in page.raw_extracted_templates:
+        doc = WikitextDocument.of(page.text, self.site)
+        for template, fielddict in doc.templates:
             # todo: l10n
             if template.lower() in ['commonscat', 'commons category']:
                 cat_name = page.title(with_ns=False)
@@ -105,7 +107,7 @@ class CommonscatCleaningBot(WikitextFixingBot, WikidataEntityBot, DeferredCallba
             claim.setTarget(cat_name)
             pywikibot.info('Category missing on Wikidata')
             self.user_add_claim(item, claim, page.site, asynchronous=True)
-            self.addCallback(page.touch)
+            self.addTouch(page)
 
 
 def main(*args):
@@ -6,7 +6,10 @@ For use in user_fixes.py, please add to the file:
 from scripts.myscripts.custome_fixes import lazy_fixes
 fixes.update((key, fix.dictForUserFixes()) for key, fix in lazy_fixes.items())
 """
+import json
+import os
 import re
+import time
 
 from collections import defaultdict
 from itertools import chain
@@ -15,13 +18,20 @@ from operator import itemgetter
 import mwparserfromhell
 import pywikibot
 
-from pywikibot import pagegenerators, textlib
+from pywikibot import config, pagegenerators, textlib
 from pywikibot.exceptions import NoPageError
 from pywikibot.tools import first_lower, first_upper
+from pywikibot.tools.itertools import itergroup
 
 from checkwiki_errors import CheckWikiError
-from tools import deduplicate, FULL_ARTICLE_REGEX
-from typoloader import TypoRule, TyposLoader
+from tools import (
+    deduplicate,
+    replace_except,
+    FULL_ARTICLE_REGEX,
+    RegexRegistry,
+    WikitextDocument,
+)
+from typoloader import RuleSandbox, TypoRule, TyposLoader
 
 
 class FixGenerator:
@@ -47,8 +57,10 @@ class BaseFix:
     '''Abstract class representing a wikitext fix'''
 
     key = None
+    namespaces = None
     options = {}
     order = 0
+    tokens = None
 
     def __init__(self, **kwargs):
         options = self.options.copy()
@@ -59,6 +71,20 @@ class BaseFix:
     def apply(self, page, *args):
         raise NotImplementedError('All fixes must be applicable')
 
+    def may_apply(self, page, text):
+        '''
+        Tell cheaply whether the fix can change the page.
+
+        The fix cannot apply when the page is not in one of namespaces or
+        the lowercased text contains none of tokens.
+        '''
+        if self.namespaces is not None:
+            if page.namespace() not in self.namespaces:
+                return False
+        if self.tokens is not None:
+            return any(token in text for token in self.tokens)
+        return True
+
     @property
     def site(self):
         if not hasattr(self, '_site'):
@@ -73,6 +99,9 @@ class BaseFix:
     def load(self):
         pass
 
+    def teardown(self):
+        pass
+
     def generator(self):
         return (x for x in [])  # empty
 
@@ -125,7 +154,7 @@ class LazyFix(BaseFix):
 
     def safeSub(self, text, find, replace):
         exceptions = self.exceptions
-        return textlib.replaceExcept(
+        return replace_except(
             text, find, replace,
             exceptions.get('inside', []) + exceptions.get('inside-tags', []),
             site=self.site)
@@ -230,9 +259,14 @@ class CategoriesFix(LazyFix):
         pass  # incategory:"Muži|Ženy|Žijící lidé" insource:/\[\[Kategorie:[^]|[]+\|[^],]+,/
 
     def load(self):
-        magic_words = map(re.escape, self.site.getmagicwords('defaultsort'))
-        self.defaultsortR = re.compile(
-            r'\{\{(?:%s)([^}]+)\}\}' % '|'.join(magic_words))
+        magic_words = self.site.getmagicwords('defaultsort')
+        self.defaultsortR = RegexRegistry.get(
+            self.site, 'defaultsort',
+            lambda: r'\{\{(?:%s)([^}]+)\}\}' % '|'.join(
+                map(re.escape, magic_words)))
+        # sort keys are either duplicate or harvested from these categories
+        self.tokens = [word.lower() for word in magic_words] + [
+            'muži', 'ženy', 'žijící lidé']
 
     def replacements(self):
         yield (FULL_ARTICLE_REGEX, self.duplicateSortKey)
@@ -287,12 +321,13 @@ class CategoriesFix(LazyFix):
 
     def duplicateSortKey(self, match):
         text = match.group()
-        matches = list(self.defaultsortR.finditer(text))
+        doc = WikitextDocument.of(text, self.site)
+        matches = doc.matches(self.defaultsortR)
         if not matches:
             return text
 
-        defaultsort = matches.pop()[1].strip()
-        categories = textlib.getCategoryLinks(text, site=self.site)
+        defaultsort = matches[-1][1].strip()
+        categories = doc.categories
         changed = False
         for category in categories:
             if self.tidy_sortkey(category.sortKey) == defaultsort:
@@ -309,11 +344,12 @@ class CategoriesFix(LazyFix):
 
     def harvestSortKey(self, match):
         text = match.group()
-        if self.defaultsortR.search(text):
+        doc = WikitextDocument.of(text, self.site)
+        if doc.matches(self.defaultsortR):
             return text
 
         keys = defaultdict(lambda: 0.0)
-        categories = textlib.getCategoryLinks(text, site=self.site)
+        categories = doc.categories
         if not any(category.title(with_ns=False) in (
                 'Muži', 'Žijící lidé', 'Ženy') for category in categories):
             return text
@@ -350,8 +386,8 @@ class CategoriesFix(LazyFix):
     def apply(self, page, summaries=[], *args):
         result = super().apply(page, summaries, *args)
         if result:
-            categories = textlib.getCategoryLinks(page.text, site=self.site)
-            categories.sort(key=self.sortCategories)
+            categories = WikitextDocument.of(page.text, self.site).categories
+            categories.sort(key=self.sort_category)
             page.text = textlib.replaceCategoryLinks(page.text, categories,
                                                      self.site)
         return result
@@ -370,8 +406,10 @@ class FilesFix(LazyFix):
     regex = r'\[\[\s*(?:%s)\s*:\s*[^]|[]+(?:\|(?:[^]|[]|\[\[[^]]+\]\])+)+\]\]'
 
     def load(self):
-        self.file_regex = re.compile(
-            self.regex % '|'.join(self.site.namespaces[6]))
+        self.file_regex = RegexRegistry.get(
+            self.site, 'file-link-params',
+            lambda: self.regex % '|'.join(self.site.namespaces[6]))
+        self.tokens = [name.lower() for name in self.site.namespaces[6]]
 
         self.wordtokey = {}
         self.keytolocal = {}
@@ -417,9 +455,10 @@ class FilesFix(LazyFix):
                 i += 1
                 continue
 
-            regex = re.compile(r'\d*x?\d+(%s)' % '|'.join(
-                re.escape(word[2:]) for word in self.wordtokey
-                if word.startswith('$1')))
+            regex = RegexRegistry.get(
+                self.site, 'file-size', lambda: r'\d*x?\d+(%s)' % '|'.join(
+                    re.escape(word[2:]) for word in self.wordtokey
+                    if word.startswith('$1')))
             if regex.fullmatch(split[i]):
                 i += 1
                 continue
@@ -450,6 +489,9 @@ class CheckWikiFix(LazyFix):  # todo: make abstract and split
     '''
     Fixes errors detected by Check Wikipedia project
 
+    Errors are marked as fixed in the background once the first page
+    is saved.
+
     Additional arguments:
     * -maxsummarycw - (not supported yet)
     '''
@@ -480,8 +522,15 @@ class CheckWikiFix(LazyFix):  # todo: make abstract and split
         page.text = self.checkwiki.apply(page.text, page, replaced, fixed)
         if replaced:  # todo: maxsummarycw
             summaries.append('[[WP:WCW|CheckWiki]]: %s' % ', '.join(replaced))
-            callbacks.append(
-                lambda: self.checkwiki.mark_as_fixed_multiple(page, fixed))
+            callbacks.append(lambda: self.mark_as_fixed(page, fixed))
+
+    def mark_as_fixed(self, page, fixed):
+        self.checkwiki.start_reporter()
+        self.checkwiki.mark_as_fixed_multiple(page, fixed)
+
+    def teardown(self):
+        if hasattr(self, 'checkwiki'):
+            self.checkwiki.stop_reporter()
 
 
 class InterwikiFix(Fix):
@@ -518,11 +567,13 @@ class RedirectFix(LazyFix):
     Fixing redirects
 
     Additional arguments:
+    * -cachedays:# - how long to remember resolved redirects (0 to disable)
     * -onlypiped - only fix links which include "|" (overriden by -always)
     '''
 
     key = 'redirects'
     options = {
+        'cachedays': 7,
         'onlypiped': False,
     }
     page_title = 'Wikipedista:PastoriBot/narovnaná přesměrování'
@@ -531,11 +582,50 @@ class RedirectFix(LazyFix):
         'text-contains': ['{{Rozcestník', '{{rozcestník'],
     }
     message = 'narovnání přesměrování'
+    linkR = re.compile(r'\[\[([^]|[<>]+)[]|]')
+    save_interval = 300  # seconds
 
     def generator(self):
-        for title in self.redirects:
-            yield from pywikibot.Page(self.site, title).backlinks(
-                followRedirects=False, filterRedirects=False, namespaces=0)
+        frontier = self.collect_backlinks(self.redirects)
+        pywikibot.info(f'{len(frontier)} pages link to the redirects')
+        # targets of all linked redirects are known before the first page
+        linked = set().union(*frontier.values())
+        self.resolve(link for link in linked if link not in self.cache)
+        # apply() does not need to look for the redirects in these pages
+        self.frontier = frontier
+        for title in sorted(frontier):
+            yield pywikibot.Page(self.site, title)
+
+    def collect_backlinks(self, titles):
+        '''Map articles to the redirects from titles they link to.'''
+        frontier = defaultdict(set)
+        for batch in itergroup(sorted(titles), 50):
+            params = {
+                'action': 'query',
+                'prop': 'linkshere',
+                'titles': batch,
+                'lhnamespace': 0,
+                'lhprop': 'title',
+                'lhshow': '!redirect',
+                'lhlimit': 'max',
+                'continue': '',
+            }
+            while True:
+                data = self.site.simple_request(**params).submit()
+                query = data.get('query', {})
+                listed = {item['to']: item['from']
+                          for item in query.get('normalized', [])}
+                pages = query.get('pages', {})
+                if isinstance(pages, dict):
+                    pages = pages.values()
+                for page in pages:
+                    redirect = listed.get(page['title'], page['title'])
+                    for link in page.get('linkshere', []):
+                        frontier[link['title']].add(redirect)
+                if 'continue' not in data:
+                    break
+                params.update(data['continue'])
+        return frontier
 
     def get_redirects(self):
         redirects = []  # todo: set?
@@ -552,35 +642,106 @@ class RedirectFix(LazyFix):
         return redirects
 
     def load(self):
-        self.cache = {}
-        self.redirects = self.get_redirects()
+        self.frontier = {}
+        self.redirects = set(self.get_redirects())
         pywikibot.info(f'{len(self.redirects)} redirects loaded')
+        self.load_cache()
+
+    @property
+    def cache_path(self):
+        return config.datafilepath(
+            'redirects', f'{self.site.dbName()}-targets.json')
+
+    def load_cache(self):
+        self.cache = {}
+        self.cache_times = {}
+        self.cache_dirty = False
+        self.cache_saved = time.monotonic()
+        if not self.cachedays:
+            return
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        expired = time.time() - self.cachedays * 24 * 3600
+        for link, (target, timestamp) in data.items():
+            if timestamp > expired:
+                self.cache[link] = target
+                self.cache_times[link] = timestamp
+
+    def save_cache(self):
+        self.cache_saved = time.monotonic()
+        if not (self.cachedays and self.cache_dirty):
+            return
+        data = {link: [target, self.cache_times[link]]
+                for link, target in self.cache.items()}
+        path = self.cache_path
+        # processes of a dry run may save at the same time
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.cache_dirty = False
+
+    def teardown(self):
+        self.save_cache()
+
+    def normalize(self, link):
+        return link.replace('_', ' ').strip()  # todo: normalize completely
+
+    def resolve(self, links):
+        '''Find targets of the links in batches and store them.'''
+        now = time.time()
+        for batch in itergroup(sorted(links), 50):
+            data = self.site.simple_request(
+                action='query', titles=batch, redirects=True).submit()
+            query = data.get('query', {})
+            normalized = {item['from']: item['to']
+                          for item in query.get('normalized', [])}
+            # links are fixed to target pages, not their sections
+            targets = {item['from']: item['to']
+                       for item in query.get('redirects', [])}
+            pages = query.get('pages', {})
+            if isinstance(pages, dict):
+                pages = pages.values()
+            missing = {page['title'] for page in pages if 'missing' in page}
+            for link in batch:
+                title = normalized.get(link, link)
+                if title in targets:
+                    target = targets[title]
+                    if link == first_lower(link):
+                        target = first_lower(target)
+                else:
+                    if title in missing:
+                        pywikibot.warning(f'{title} does not exist')
+                    else:
+                        pywikibot.warning(f'{title} is not a redirect')
+                    target = False
+                self.cache[link] = target
+                self.cache_times[link] = now
+                self.cache_dirty = True
+        if time.monotonic() - self.cache_saved > self.save_interval:
+            self.save_cache()
 
     def from_cache(self, link):
-        link = link.replace('_', ' ').strip()  # todo: normalize completely
+        link = self.normalize(link)
         if link not in self.redirects:
             return False
 
         if link not in self.cache:
-            page = pywikibot.Page(self.site, link)
-            if not page.exists():
-                pywikibot.warning(f'{page.title()} does not exist')
-                self.redirects.remove(link)  # fixme: both cases
-                return False
-            if not page.isRedirectPage():
-                pywikibot.warning(f'{page.title()} is not a redirect')
-                self.redirects.remove(link)  # fixme: both cases
-                return False
-
-            target = page.getRedirectTarget()
-            title = target.title()
-            if link == first_lower(link):
-                self.cache[link] = first_lower(title)
-            else:
-                self.cache[link] = title
-
+            self.resolve([link])
         return self.cache[link]
 
+    def apply(self, page, summaries=[], callbacks=[]):
+        linked = self.frontier.pop(page.title(), None)
+        if linked is None:
+            links = {self.normalize(match[1])
+                     for match in self.linkR.finditer(page.text)}
+            linked = links & self.redirects
+        self.resolve(link for link in linked if link not in self.cache)
+        return super().apply(page, summaries, callbacks)
+
     def replacements(self):
         yield (r'\[\[([^]|[<>]+)\|', self.replace1)
         yield (r'\[\[([^]|[<>]+)\]\](%s)?' % self.site.linktrail(),
@@ -652,6 +813,7 @@ class RefSortFix(LazyFix):
     key = 'sortref'
     message = 'seřazení referencí'
     order = 2  # after checkwiki
+    tokens = ['<ref']
 
     def load(self):
         self.regex_single = re.compile(
@@ -688,7 +850,8 @@ class RefSortFix(LazyFix):
             return text
 
         all_names = []
-        for match in self.regex_single.finditer(text):
+        doc = WikitextDocument.of(text, self.site)
+        for match in doc.matches(self.regex_single):
             name = match.group(1) or match.group(2)
             if not name:
                 continue
@@ -738,6 +901,12 @@ class SectionsFix(LazyFix):
     def load(self):
         self.parser = mwparserfromhell
         self.can_load = not isinstance(self.parser, Exception)
+        self.all_headers = frozenset(self.iter_all_headers())
+        self.header_order = {
+            name: i for i, name in enumerate(self.headers_in_order)}
+        self.defaultsort = tuple(self.site.getmagicwords('defaultsort'))
+        self.tokens = [header.lower() for header in chain(
+            self.all_headers, self.replace_headers)]
 
     def replacements(self):
         if self.can_load:
@@ -750,13 +919,12 @@ class SectionsFix(LazyFix):
         return chain(self.headers_in_order, self.bad_headers, [self.root_header])
 
     def add_contents(self, sections, code):
-        next_index = code.nodes.index(sections[0]['nodes'][-1])
-        for i in range(1, len(sections)):
-            this_index = code.nodes.index(sections[i-1]['nodes'][0])
-            next_index = code.nodes.index(sections[i]['nodes'][0], this_index+1)
-            sections[i-1]['nodes'].extend(code.nodes[this_index+1:next_index])
+        # each section starts at the position of its heading
+        for sect, next_sect in zip(sections, sections[1:]):
+            sect['nodes'].extend(
+                code.nodes[sect['index'] + 1:next_sect['index']])
 
-        index = next_index + 1
+        index = sections[-1]['index'] + 1
         for index, node in enumerate(code.nodes[index:], start=index):
             if isinstance(node, self.parser.nodes.wikilink.Wikilink):
                 text = str(node)[2:-2]
@@ -770,8 +938,7 @@ class SectionsFix(LazyFix):
                 if link.namespace == 14:
                     break
             elif isinstance(node, self.parser.nodes.template.Template):
-                if node.name.startswith(
-                    tuple(self.site.getmagicwords('defaultsort'))):
+                if node.name.startswith(self.defaultsort):
                     break
                 if any(node.name.matches(x) for x in ('Překlad', 'ID autority')):
                     pass
@@ -784,17 +951,21 @@ class SectionsFix(LazyFix):
         return index
 
     def deduplicate(self, sections, code):
+        by_name = {}
+        for sect in sections:
+            by_name.setdefault(sect['name'], []).append(sect)
+
         do_more = False
-        for name in {sect['name'] for sect in sections}:
-            dupes = [sect for sect in sections if sect['name'] == name]
+        for dupes in by_name.values():
             if len(dupes) == 1:
                 continue
+            # contents of all duplicates are merged into the last one
             do_more = True
-            i = len(dupes) - 2
-            while i > -1:
-                dupes[-1]['nodes'][1:1] = dupes[i]['nodes'][1:]
-                dupes.pop(i)
-                i -= 1
+            dupes[-1]['nodes'][1:1] = [
+                node for sect in dupes[:-1] for node in sect['nodes'][1:]]
+        if do_more:
+            sections[:] = [sect for sect in sections
+                           if by_name[sect['name']][-1] is sect]
 
         for sect in sections:
             old_title = sect['nodes'][0].title
@@ -807,8 +978,8 @@ class SectionsFix(LazyFix):
     def sortkey(self, sect):
         if sect['name'] == self.root_header:
             return -1
-        if sect['name'] in self.headers_in_order:
-            return self.headers_in_order.index(sect['name'])
+        if sect['name'] in self.header_order:
+            return self.header_order[sect['name']]
         pywikibot.warning(f"Found unknown header: \"{sect['name']}\"")
         return len(self.headers_in_order)
 
@@ -832,14 +1003,12 @@ class SectionsFix(LazyFix):
         pass
 
     def clean_empty(self, sections, code, do_more):
-        to_remove = []
-        for sect in sections[:-1]:  # todo
-            if sect['name'] == self.root_header:
-                continue
-            if not ''.join(map(str, sect['nodes'][1:])).strip():
-                to_remove.append(sect)
-        for sect in to_remove:
-            sections.remove(sect)
+        kept = [sect for sect in sections[:-1]  # todo
+                if sect['name'] == self.root_header
+                or ''.join(map(str, sect['nodes'][1:])).strip()]
+        kept.append(sections[-1])
+        if len(kept) < len(sections):
+            sections[:] = kept
             do_more = True
         if do_more:
             for sect in sections:
@@ -849,25 +1018,30 @@ class SectionsFix(LazyFix):
 
     def replace(self, match):
         text = match.group()
-        code = self.parser.parse(text, skip_style_tags=True)
+        doc = WikitextDocument.of(text, self.site)
+        code = doc.code
         sections = []
-        for header in code.ifilter_headings():
+        for index, header in enumerate(code.nodes):
+            if not isinstance(header, self.parser.nodes.Heading):
+                continue
             name = header.title.strip()
             if name in self.replace_headers:
                 name = self.replace_headers[name]
-            if name in self.iter_all_headers():
+            if name in self.all_headers:
                 sections.append({
                     'name': first_upper(name),
                     'nodes': [header],
+                    'index': index,
                 })
             else:
                 sections[:] = []
         if not sections:
             return text
 
+        # the tree is modified from now on
+        code = doc.edit()
         do_more = False
-        first_index = min(code.nodes.index(sect['nodes'][0])
-                          for sect in sections)
+        first_index = sections[0]['index']
         last_index = self.add_contents(sections, code)
         do_more = self.deduplicate(sections, code) or do_more
         do_more = self.check_levels(sections, code) or do_more
@@ -877,7 +1051,7 @@ class SectionsFix(LazyFix):
         self.clean_empty(sections, code, do_more)
         code.nodes[first_index:last_index] = [node for sect in sections
                                               for node in sect['nodes']]
-        return str(code)
+        return doc.derive(code)
 
 
 class StyleFix(Fix):  # todo: split and delete
@@ -912,6 +1086,7 @@ class TemplateFix(LazyFix):
 
     key = 'templates'
     message = 'narovnání šablon'
+    tokens = ['{{']
 
     def load(self):
         self.cache = {}
@@ -963,6 +1138,8 @@ class TypoFix(LazyFix):
     Additional arguments:
     * -maxsummarytypos - how many typo replacements to show in edit
       summary at most?
+    * -ruletimeout - skip rule on page if it runs longer than this
+      many seconds (0 to disable)
     * -typospage
     * -whitelistpage
     '''
@@ -970,6 +1147,7 @@ class TypoFix(LazyFix):
     key = 'typos'
     options = {
         'maxsummarytypos': 5,
+        'ruletimeout': 10,
         'typospage': None,
         'whitelistpage': None,
     }
@@ -981,13 +1159,25 @@ class TypoFix(LazyFix):
 
     def load(self):
         loader = TyposLoader(self.site)
+        self.loader = loader
         self.typoRules = loader.loadTypos()
+        self.prefilter = loader.prefilter
         self.whitelist = loader.loadWhitelist()
+        self.sandbox = None
+        if self.ruletimeout:
+            self.sandbox = RuleSandbox(self.ruletimeout)
+
+    def teardown(self):
+        if getattr(self, 'sandbox', None) is not None:
+            self.sandbox.stop()
+        if hasattr(self, 'loader') and self.loader.profile is not None:
+            self.loader.profile.save()
+        super().teardown()
 
     def generator(self):
-        return chain.from_iterable(
-            self.site.search(rule.query, namespaces=[0])
-            for rule in self.typoRules if rule.query is not None)
+        # each page found by any query is yielded only once
+        for title in self.loader.searchIndex(self.typoRules):
+            yield pywikibot.Page(self.site, title)
 
     def replacements(self):
         return ((rule.find.pattern, rule.replacements[0])
@@ -999,10 +1189,16 @@ class TypoFix(LazyFix):
             return
         text = page.text
         replaced = []
+        candidates = self.prefilter.candidates(text)
         for rule in self.typoRules:
-            if rule.matches(title):
+            if rule.id not in candidates:
+                continue
+            if rule.find.search(title):
                 continue
-            text = rule.apply(text, replaced)
+            new_text = rule.apply(text, replaced, self.sandbox)
+            if new_text != text:
+                candidates = self.prefilter.update(candidates, text, new_text)
+                text = new_text
         page.text = text
         count = len(replaced)
         if count > 0:  # todo: separate function
@@ -1,38 +1,76 @@
+import time
+
+from collections import deque
+
 import pywikibot
 
 from pywikibot.bot import BaseBot
+from pywikibot.tools.itertools import itergroup
 
 
 class DeferredCallbacksBot(BaseBot):
 
     '''
     Bot deferring callbacks like purging pages
+
+    Purges and touches are collected per site and done in batches when
+    enough of them are pending or some time has passed, other callbacks
+    are executed in the order they were added.
     '''
 
+    batch_size = 50
+    flush_interval = 120  # seconds
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.callbacks = []
+        self.callbacks = deque()
+        self.purges = {}
+        self.last_flush = time.monotonic()
 
     def addCallback(self, func, *data, **kwargs):
         callback = lambda *_, **__: func(*data, **kwargs)
         self.callbacks.append(callback)
 
+    def addPurge(self, page, forcelinkupdate=False):
+        key = (page.site, forcelinkupdate)
+        pages = self.purges.setdefault(key, {})
+        pages.setdefault(page.title(), page)
+        if len(pages) >= self.batch_size:
+            self.flushPurges(key)
+        elif time.monotonic() - self.last_flush > self.flush_interval:
+            self.flushPurges()
+
+    def addTouch(self, page):
+        # a purge updating links does the same as a null edit
+        # and can be done for many pages at once
+        self.addPurge(page, forcelinkupdate=True)
+
+    def flushPurges(self, *keys):
+        for key in keys or list(self.purges):
+            site, forcelinkupdate = key
+            pages = list(self.purges.pop(key, {}).values())
+            for batch in itergroup(pages, self.batch_size):
+                if not site.purgepages(batch, forcelinkupdate=forcelinkupdate):
+                    pywikibot.warning(f'Failed to purge {len(batch)} pages')
+        self.last_flush = time.monotonic()
+
     def queueLen(self):
-        return len(self.callbacks)
+        return len(self.callbacks) + sum(map(len, self.purges.values()))
 
     def hasCallbacks(self):
-        return self.queueLen() > 0
+        return len(self.callbacks) > 0
 
     def doWithCallback(self, func, *data, **kwargs):
         if self.hasCallbacks():
-            kwargs['callback'] = self.callbacks.pop(0)
+            kwargs['callback'] = self.callbacks.popleft()
         return func(*data, **kwargs)
 
     def teardown(self):
         pywikibot.info(f'Executing remaining deferred callbacks: {self.queueLen()} left')
         try:
             while self.hasCallbacks():
-                callback = self.callbacks.pop(0)
+                callback = self.callbacks.popleft()
                 callback()
+            self.flushPurges()
         finally:
-            pass
+            super().teardown()
@@ -1,7 +1,8 @@
 #!/usr/bin/python
+import multiprocessing
 import re
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import pywikibot
 
@@ -10,20 +11,85 @@ from pywikibot.bot import SingleSiteBot, ExistingPageBot
 from pywikibot.pagegenerators import PreloadingGenerator
 from pywikibot.tools.itertools import itergroup
 
-from typoloader import TypoRule, TyposLoader
+from tools import iter_dump_pages
+from typoloader import TypoPrefilter, TypoRule, TyposLoader
+
+
+def remove_disabled_parts(text, regexes):
+    for regex in regexes:
+        text = regex.sub('', text)
+    return text
+
+
+def find_matches(text, rules, regexes):
+    clean_text = None
+    for rule in rules:
+        if not rule.find.search(text):
+            continue
+        if clean_text is None:
+            clean_text = remove_disabled_parts(text, regexes)
+        found = set()
+        for match in rule.find.finditer(clean_text):
+            match_text = match[0]
+            if match_text not in found:
+                found.add(match_text)
+                yield match_text
+
+
+_worker = {}
+
+
+def _init_worker(rules, regexes):
+    rules = [TypoRule.newFromDict(data) for data in rules]
+    _worker['rules'] = rules
+    _worker['prefilter'] = TypoPrefilter(rules)
+    _worker['regexes'] = regexes
+
+
+def _scan_chunk(chunk):
+    rules = _worker['rules']
+    results = []
+    for title, text in chunk:
+        candidates = _worker['prefilter'].candidates(text)
+        page_rules = (rule for rule in rules
+                      if rule.id in candidates and not rule.find.search(title))
+        matches = list(find_matches(text, page_rules, _worker['regexes']))
+        if matches:
+            results.append((title, matches))
+    return results
 
 
 class TypoReportBot(SingleSiteBot):
 
+    '''
+    Bot listing typos found in articles
+
+    Supported parameters:
+    * -anything - save the list even if the bot did not finish
+    * -backlog:# - how many chunks can wait for workers (default twice
+      the number of workers)
+    * -chunksize:# - how many pages to send to a worker at once
+    * -dump: - scan a local XML or JSON lines dump instead of searching
+    * -false_positives: - page with matches that should not be listed
+    * -outputpage: - where to save the list
+    * -typospage: - what page do you want to load typo rules from
+    * -whitelistpage: - what page holds pages which should be skipped
+    * -workers:# - scan the dump in # processes
+    '''
+
     pattern = '# {} \u2013 {}'
 
     def __init__(self, **kwargs):
         self.available_options.update({
             'always': True,
             'anything': False,
+            'backlog': 0,
+            'chunksize': 100,
+            'dump': None,
             'outputpage': None,
             'typospage': None,
             'whitelistpage': None,
+            'workers': 0,
             'false_positives': None,
         })
         super().__init__(**kwargs)
@@ -35,6 +101,11 @@ class TypoReportBot(SingleSiteBot):
     def setup(self):
         super().setup()
         self.typoRules = self.loader.loadTypos()
+        self.prefilter = self.loader.prefilter
+        self.disabled_regexes = textlib._get_regexes(
+            TypoRule.exceptions, self.site)
+        self.index = None
+        self.found = {}
         #self.fp_page = self.loader.getWhitelistPage()
         self.whitelist = self.loader.loadWhitelist()
         self.data = defaultdict(list)
@@ -52,14 +123,48 @@ class TypoReportBot(SingleSiteBot):
 
     @property
     def generator(self):
-        for rule in self.typoRules:
-            if rule.query is None:
-                continue
+        if self.opt.dump and self.opt.workers:
+            yield from self.pool_generator()
+            return
+
+        if self.opt.dump:
+            yield from self.dump_generator()
+            return
+
+        # each page is loaded once and checked by rules which found it
+        self.index = self.loader.searchIndex(self.typoRules)
+        yield from PreloadingGenerator(
+            pywikibot.Page(self.site, title) for title in self.index)
+
+    def dump_generator(self):
+        # all rules are applied to each page, see treat
+        for entry in iter_dump_pages(self.opt.dump, namespaces=[0]):
+            page = pywikibot.Page(self.site, entry.title)
+            page.text = entry.text
+            yield page
+
+    def pool_generator(self):
+        # pages are scanned by workers, only those with matches are yielded
+        rules = [rule.toDict() for rule in self.typoRules]
+        backlog = self.opt.backlog or 2 * self.opt.workers
+        pending = deque()
+        entries = ((entry.title, entry.text)
+                   for entry in iter_dump_pages(self.opt.dump, namespaces=[0]))
+        with multiprocessing.Pool(
+                self.opt.workers, _init_worker,
+                (rules, self.disabled_regexes)) as pool:
+            for chunk in itergroup(entries, self.opt.chunksize):
+                pending.append(pool.apply_async(_scan_chunk, (chunk,)))
+                while len(pending) >= backlog:
+                    yield from self.merge_results(pending.popleft().get())
+            while pending:
+                yield from self.merge_results(pending.popleft().get())
 
-            pywikibot.info(f'Query: "{rule.query}"')
-            self.current_rule = rule
-            yield from PreloadingGenerator(
-                self.site.search(rule.query, namespaces=[0]))
+    def merge_results(self, results):
+        for title, matches in results:
+            page = pywikibot.Page(self.site, title)
+            self.found[page.title()] = matches
+            yield page
 
     def skip_page(self, page):
         # TODO: better terminology
@@ -67,29 +172,32 @@ class TypoReportBot(SingleSiteBot):
             pywikibot.warning(f'Skipped {page} because it is whitelisted')
             return True
 
-        if self.current_rule.find.search(page.title()):
-            pywikibot.warning(
-                f'Skipped {page} because the rule matches the title')
-            return True
-
         return super().skip_page(page)
 
     def remove_disabled_parts(self, text):
         return textlib.removeDisabledParts(
             text, TypoRule.exceptions, site=self.site)
 
+    def iter_rules(self, page):
+        title = page.title()
+        if self.index is not None:
+            rules = self.index.get(title, [])
+        else:
+            candidates = self.prefilter.candidates(page.text)
+            rules = (rule for rule in self.typoRules if rule.id in candidates)
+        for rule in rules:
+            # skip rules matching the title
+            if not rule.find.search(title):
+                yield rule
+
     def treat(self, page):
-        match = self.current_rule.find.search(page.text)
-        if not match:
-            return
-        text = self.remove_disabled_parts(page.text)
-        found = set()
-        for match in self.current_rule.find.finditer(text):
-            match_text = match[0]
-            if match_text in found:
-                continue
-            found.add(match_text)
-            link = page.title(as_link=True)
+        link = page.title(as_link=True)
+        if self.opt.dump and self.opt.workers:
+            matches = self.found.pop(page.title(), [])
+        else:
+            matches = find_matches(
+                page.text, self.iter_rules(page), self.disabled_regexes)
+        for match_text in matches:
             put_text = self.pattern.format(link, match_text)
             if put_text[2:] not in self.false_positives:
                 pywikibot.stdout(put_text)
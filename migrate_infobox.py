@@ -4,8 +4,10 @@ import re
 from itertools import chain
 from random import choice
 
+import mwparserfromhell
 import pywikibot
 
+from mwparserfromhell.nodes import Text
 from pywikibot import pagegenerators, textlib
 from pywikibot.tools import first_upper
 
@@ -99,118 +101,89 @@ class InfoboxMigratingBot(WikitextFixingBot):
             super().treat(page)
 
     def treat_page(self):
-        text = self.current_page.text
-        start = 0
-        while True:
-            before, after = text[:start], text[start:]
-            new, start = self.find_and_replace(after, start == 0)
-            text = before + new
-            if after == new:
-                break
-        self.put_current(text, summary=self.summary)
-
-    def find_and_replace(self, text, init):
+        code = mwparserfromhell.parse(
+            self.current_page.text, skip_style_tags=True)
+        self.migrate(code)
+        self.put_current(str(code), summary=self.summary)
+
+    def is_migrated(self, template):
+        return self.normalize(str(template.name)) in (self.template,
+                                                      self.new_template)
+
+    def migrate(self, wikicode):
+        '''Rewrite all occurrences of the template in the wikicode.'''
+        templates = wikicode.filter_templates(
+            recursive=True, matches=self.is_migrated)
+        # nested templates first, their parents then include the new text
+        for template in reversed(templates):
+            new_template = self.migrate_template(template)
+            if new_template is None:
+                continue
+            try:
+                index = wikicode.index(template)
+            except ValueError:  # nested
+                wikicode.replace(template, Text(new_template))
+                continue
+            nodes = wikicode.nodes
+            nodes[index] = Text(new_template)
+            # the new template ends with a newline
+            if index + 1 < len(nodes) and isinstance(nodes[index + 1], Text):
+                nodes[index + 1].value = nodes[index + 1].value.lstrip()
+
+    def migrate_template(self, template):
+        '''Return the new text of the template or None to keep it.'''
         new_params = []
         old_params = []
         unknown_params = []
         removed_params = []
-        changed = False
-        for template, fielddict in textlib.extract_templates_and_params(
-                text, remove_disabled_parts=False, strip=False):
-            if self.normalize(template) not in (self.template,
-                                                self.new_template):
-                continue
-
-            changed = self.normalize(template) != self.new_template
-            start_match = re.search(r'\{\{\s*((%s)\s*:\s*)?%s\s*' % (
-                '|'.join(self.site.namespaces[10]), re.escape(template)), text)
-            if not start_match:
-                if not init:
-                    pywikibot.error("Couldn't find the template")
-                return text, 0
-
-            start = start_match.start()
-            if len(fielddict) > 0:
-                end = text.index('|', start)
+        fielddict = {str(param.name): str(param.value)
+                     for param in template.params}
+        changed = self.normalize(str(template.name)) != self.new_template
+        unnamed = {}
+        for name, value in chain(fielddict.items(), IterUnnamed(unnamed)):
+            name = name.strip()
+            value = (value
+                     .replace('\n<!-- Zastaralé parametry -->', '')
+                     .replace('\n<!-- Neznámé parametry -->', '')
+                     .strip())
+
+            try:
+                new_name = self.handle_param(name)
+            except OldParamException:
+                if textlib.removeDisabledParts(value, ['comments']).strip():
+                    old_params.append(
+                        (name, value)
+                    )
+            except RemoveParamException:
+                changed = True
+                if textlib.removeDisabledParts(value, ['comments']).strip():
+                    removed_params.append(
+                        (name, value)
+                    )
+            except UnknownParamException:
+                if textlib.removeDisabledParts(value, ['comments']).strip():
+                    unknown_params.append(
+                        (name, value)
+                    )
+            except AssertionError:
+                pywikibot.error(f"Couldn't handle parameter '{name}'")
+                return None
+            except UnnamedParamException:
+                unnamed[value] = ''
             else:
-                end = text.index('}}', start)
-
-            unnamed = {}
-            for name, value in chain(fielddict.items(), IterUnnamed(unnamed)):
-                end += len(f'|{name}={value}')
-
-                name = name.strip()
-                value = (value
-                         .replace('\n<!-- Zastaralé parametry -->', '')
-                         .replace('\n<!-- Neznámé parametry -->', '')
-                         .strip())
-
-                try:
-                    new_name = self.handle_param(name)
-                except OldParamException:
-                    if textlib.removeDisabledParts(value, ['comments']).strip():
-                        old_params.append(
-                            (name, value)
-                        )
-                except RemoveParamException:
+                new_params.append(
+                    (new_name, value)
+                )
+                if new_name != name:
                     changed = True
-                    if textlib.removeDisabledParts(value, ['comments']).strip():
-                        removed_params.append(
-                            (name, value)
-                        )
-                except UnknownParamException:
-                    if textlib.removeDisabledParts(value, ['comments']).strip():
-                        unknown_params.append(
-                            (name, value)
-                        )
-                except AssertionError:
-                    pywikibot.error(f"Couldn't handle parameter '{name}'")
-                    return text, 0
-                except UnnamedParamException:
-                    unnamed[value] = ''
-                else:
-                    new_params.append(
-                        (new_name, value)
-                    )
-                    if new_name != name:
-                        changed = True
-
-            end += len('}}')
-
-            while text[start:end].count('{{') < text[start:end].count('}}'):
-                end = text[:end].rindex('}}') + len('}}')
-
-            if text[start:end].count('{{') > text[start:end].count('}}'):
-                ballance = 1
-                end = start
-                while ballance > 0:
-                    next_close = text.index('}}', end)
-                    ballance += text[end:next_close].count('{{') - 1
-                    end = next_close + len('}}')
-
-            if not text[start:end].endswith('}}'):  # elif?
-                end = text[:end].rindex('}}') + len('}}')
-
-            if (end < start or not text[start:end].endswith('}}') or
-                    text[start:end].count('{{') != text[start:end].count('}}')):
-                pywikibot.error("Couldn't parse the template")
-                return text, 0
-            break
-
-        else:
-            pywikibot.error("Couldn't parse the template")
-            return text, 0
 
         if not changed:
             pywikibot.info('No parameters changed')
-            return text, 0
-
-        while end < len(text) and text[end].isspace():  # todo: also before
-            end += 1
+            return None
 
         lines = []
         nested = 0
-        for line in text[start:end].splitlines():
+        for line in str(template).splitlines():
             if nested == 1 and re.match(' *\|', line):
                 lines.append(line)
             nested += line.count('{{') - line.count('}}')
@@ -240,8 +213,7 @@ class InfoboxMigratingBot(WikitextFixingBot):
                 new_template += f'{space_before}| {param} = {value}\n'
 
         new_template += '}}\n'
-
-        return text[:start] + new_template + text[end:], end
+        return new_template
 
     def key_for_sort(self, value):
         name = value[0]
@@ -414,7 +386,7 @@ class InfoboxMigratingBot(WikitextFixingBot):
             image = re.sub('[ _]+', ' ', image).strip()
 
             if image.lower().startswith(tuple(
-                    '%s:' % ns.lower() for ns in self.site.namespaces[6]))
+                    '%s:' % ns.lower() for ns in self.site.namespaces[6])):
                 image = image.partition(':')[2].strip()
 
         return image, size, caption
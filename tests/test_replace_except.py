@@ -0,0 +1,75 @@
+import re
+import unittest
+
+try:
+    from pywikibot import textlib
+except ImportError:
+    raise unittest.SkipTest('pywikibot is not installed')
+
+from tools import replace_except
+
+
+class TestReplaceExcept(unittest.TestCase):
+
+    '''replace_except must give the same results as textlib.replaceExcept'''
+
+    def assertSameReplace(self, text, old, new, exceptions=(), count=0):
+        exceptions = list(exceptions)
+        expected = textlib.replaceExcept(
+            text, old, new, exceptions, count=count)
+        self.assertEqual(
+            replace_except(text, old, new, exceptions, count=count), expected)
+        # the second call reuses searches for exceptions
+        self.assertEqual(
+            replace_except(text, old, new, exceptions, count=count), expected)
+        return expected
+
+    def test_lookbehind(self):
+        result = self.assertSameReplace('aaaa', re.compile('(?<=a)a'), 'b')
+        self.assertEqual(result, 'abab')
+
+    def test_lookbehind_exception(self):
+        self.assertSameReplace(
+            'aaba', re.compile('a'), 'b', [re.compile('(?<=b)a')])
+
+    def test_empty_matches(self):
+        self.assertSameReplace('abc', re.compile('x*'), '-')
+        self.assertSameReplace('abba', re.compile('(?=b)'), '|')
+
+    def test_groups(self):
+        self.assertSameReplace('a1 b2', re.compile(r'(\w)(\d)'), r'\2\1')
+        self.assertSameReplace(
+            'a1 b2', re.compile(r'(?P<x>\w)\d'), r'\g<x>\n')
+
+    def test_count(self):
+        self.assertSameReplace('aaaa', re.compile('a'), 'b', count=2)
+
+    def test_callback_sees_changed_text(self):
+        def callback(match):
+            return match.string[max(0, match.start() - 1):match.start()]
+
+        self.assertSameReplace('abcabc', re.compile('[bc]'), callback)
+
+    def test_exceptions(self):
+        self.assertSameReplace(
+            'a<!--a-->a<nowiki>a</nowiki>a', re.compile('a'), 'b',
+            ['comment', 'nowiki'])
+
+    def test_exception_next_to_replacement(self):
+        self.assertSameReplace(
+            'a<!--a-->a', re.compile('a<'), 'b', ['comment'])
+        self.assertSameReplace(
+            'a"a"a', re.compile('a'), '"', [re.compile('"[^"]*"')])
+
+    def test_replacement_creates_exception(self):
+        def callback(match):
+            return '<!--' if match[1] else 'c'
+
+        self.assertSameReplace(
+            'ba-->a', re.compile('(b)|a'), callback, ['comment'])
+        self.assertSameReplace(
+            'xa"a', re.compile('x|a'), '"', [re.compile('"[^"]*"')])
+
+
+if __name__ == '__main__':
+    unittest.main()
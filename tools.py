@@ -1,38 +1,127 @@
+import bz2
+import gzip
+import json
 import re
-from collections import OrderedDict
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque, namedtuple
 from typing import Any
 
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+import mwparserfromhell
 import pywikibot
+from pywikibot import textlib, xmlreader
 from pywikibot.tools.chars import url2string
 
+try:
+    from pywikibot.textlib import get_regexes
+except ImportError:  # older pywikibot
+    from pywikibot.textlib import _get_regexes as get_regexes
+
 FULL_ARTICLE_REGEX = r'\A[\s\S]*\Z'
 
+DumpEntry = namedtuple('DumpEntry', 'title ns text timestamp isredirect')
+
+# characters matched by each other with re.IGNORECASE although
+# their lowercase forms differ
+_CASE_FOLDS = str.maketrans(
+    '\u0131\u017f\u00b5\u0345\u1fbe\u1fd3\u1fe3\u03d0\u03f5\u03d1\u03f0'
+    '\u03d6\u03f1\u03c2\u03d5\u1c80\u1c81\u1c82\u1c83\u1c84\u1c85\u1c86'
+    '\u1c87\u1c88\u1e9b\ufb05',
+    'is\u03bc\u03b9\u03b9\u0390\u03b0\u03b2\u03b5\u03b8\u03ba'
+    '\u03c0\u03c1\u03c3\u03c6\u0432\u0434\u043e\u0441\u0442\u0442\u044a'
+    '\u0463\ua64b\u1e61\ufb06')
+
+
+def fold_case(text):
+    '''
+    Lowercase the text so that it contains the folded literals from
+    required_literals wherever their expression matches.
+    '''
+    # "İ" is matched by "i" but lowercased to two characters
+    return text.replace('\u0130', 'i').lower().translate(_CASE_FOLDS)
+
+
+def common_prefix(first, second):
+    '''Return the length of the common prefix of two strings.'''
+    # bisection, slices are compared much faster than single characters
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def changed_span(old, new):
+    '''Return the start of the changed part and its ends in both texts.'''
+    start = common_prefix(old, new)
+    end = common_prefix(old[start:][::-1], new[start:][::-1])
+    return start, len(old) - end, len(new) - end
+
+
+class RegexRegistry:
+
+    '''
+    Compiled expressions depending on magic words or namespaces of a site
+
+    Each expression is built once per site and name, the number of uses
+    of each is kept in usage.
+    '''
+
+    _regexes = {}
+    usage = Counter()
+
+    @classmethod
+    def get(cls, site, name, build, flags=0):
+        '''
+        Return the expression, build() returns its pattern or the compiled
+        expression when it is not known yet.
+        '''
+        key = (site.sitename if site is not None else None, name)
+        regex = cls._regexes.get(key)
+        if regex is None:
+            regex = build()
+            if isinstance(regex, str):
+                regex = re.compile(regex, flags)
+            cls._regexes[key] = regex
+        cls.usage[key] += 1
+        return regex
+
 
 class FileRegexHolder:
 
-    replaceR = None
     FLOAT_PATTERN = r'\d+(?:\.\d+)?'
 
     @classmethod
     def get_regex(cls, site):
-        if not cls.replaceR:
-            magic = ['img_baseline', 'img_border', 'img_bottom', 'img_center',
-                     'img_class', 'img_framed', 'img_frameless', 'img_left',
-                     'img_middle', 'img_none', 'img_right', 'img_sub',
-                     'img_super', 'img_text_bottom', 'img_text_top',
-                     'img_thumbnail', 'img_top']
-            words = []
-            for magicword in magic:
-                words.extend(site.getmagicwords(magicword))
-            replace = '|'.join(map(re.escape, words))
-            for magicword in site.getmagicwords('img_manualthumb'):
-                replace += '|' + magicword.replace('$1', cls.FLOAT_PATTERN)
-            for magicword in site.getmagicwords('img_upright'):
-                replace += '|' + magicword.replace('$1', cls.FLOAT_PATTERN)
-            for magicword in site.getmagicwords('img_width'):
-                replace += '|' + magicword.replace('$1', r'\d+')
-            cls.replaceR = re.compile(replace)
-        return cls.replaceR
+        return RegexRegistry.get(
+            site, 'file-params', lambda: cls._build_pattern(site))
+
+    @classmethod
+    def _build_pattern(cls, site):
+        magic = ['img_baseline', 'img_border', 'img_bottom', 'img_center',
+                 'img_class', 'img_framed', 'img_frameless', 'img_left',
+                 'img_middle', 'img_none', 'img_right', 'img_sub',
+                 'img_super', 'img_text_bottom', 'img_text_top',
+                 'img_thumbnail', 'img_top']
+        words = []
+        for magicword in magic:
+            words.extend(site.getmagicwords(magicword))
+        replace = '|'.join(map(re.escape, words))
+        for magicword in site.getmagicwords('img_manualthumb'):
+            replace += '|' + magicword.replace('$1', cls.FLOAT_PATTERN)
+        for magicword in site.getmagicwords('img_upright'):
+            replace += '|' + magicword.replace('$1', cls.FLOAT_PATTERN)
+        for magicword in site.getmagicwords('img_width'):
+            replace += '|' + magicword.replace('$1', r'\d+')
+        return replace
 
 
 class LRUCache:
@@ -59,6 +148,427 @@ class LRUCache:
             self._cache.popitem(last=False)
 
 
+class LiteralMatcher:
+
+    '''
+    Aho-Corasick automaton telling which of many literals occur in a text
+
+    The text is scanned only once regardless of the number of literals.
+    '''
+
+    def __init__(self, literals) -> None:
+        self.literals = list(literals)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        for index, literal in enumerate(self.literals):
+            state = 0
+            for char in literal:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._out[state].add(index)
+
+        self.alphabet = frozenset(char for literal in self.literals
+                                  for char in literal)
+        self.longest = max(map(len, self.literals), default=0)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] |= self._out[self._fail[child]]
+
+    def search(self, text) -> set:
+        '''Return indexes of all literals found in the text.'''
+        found = set()
+        goto, fail, out = self._goto, self._fail, self._out
+        alphabet = self.alphabet
+        state = 0
+        for char in text:
+            if char not in alphabet:
+                state = 0
+                continue
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+def _required_literals(parsed):
+    candidates = []
+    run = []
+
+    def flush():
+        if run:
+            candidates.append([''.join(run)])
+            run.clear()
+
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+        elif op is sre_constants.AT:
+            pass  # zero-width, literals around are still adjacent
+        elif op is sre_constants.SUBPATTERN:
+            flush()
+            sub = _required_literals(av[-1])
+            if sub:
+                candidates.append(sub)
+        elif op is sre_constants.BRANCH:
+            flush()
+            alternatives = []
+            for item in av[1]:
+                sub = _required_literals(item)
+                if not sub:
+                    break
+                alternatives.extend(sub)
+            else:
+                candidates.append(alternatives)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            flush()
+            if av[0] > 0:
+                sub = _required_literals(av[2])
+                if sub:
+                    candidates.append(sub)
+        else:
+            flush()
+    flush()
+
+    if not candidates:
+        return None
+    return max(candidates,
+               key=lambda alts: (min(map(len, alts)), -len(alts)))
+
+
+def required_literals(regex, flags=0):
+    '''
+    Return literals of which at least one occurs in any match of the regex.
+
+    Literals are folded by fold_case so that they can be looked up
+    in folded text regardless of the regex flags. None is returned when
+    no such literals can be determined. The regex does not need to be
+    compiled.
+    '''
+    if not isinstance(regex, str):
+        regex, flags = regex.pattern, regex.flags
+    try:
+        parsed = sre_parse.parse(regex, flags)
+    except Exception:
+        return None
+    literals = _required_literals(parsed)
+    if literals is None:
+        return None
+    return sorted({fold_case(literal) for literal in literals})
+
+
+class ProtectedSpans:
+
+    '''
+    Matches of exceptions of textlib.replaceExcept in a text
+
+    Searches for exceptions are remembered and shared by all replacements
+    done on the same text until one of them changes it. The result of
+    a search from an index is also the result of searches from all
+    indexes between that one and the start of the match.
+    '''
+
+    _cache = LRUCache(4)
+    groupR = re.compile(r'\\(\d+)|\\g<(.+?)>')
+
+    def __init__(self, text, site=None) -> None:
+        self.text = text
+        self.site = site
+        # regex -> starts and ends of matches found and the lowest
+        # indexes they were searched from
+        self._found = {}
+        # regex -> the lowest index without matches after it
+        self._missing = {}
+
+    @classmethod
+    def of(cls, text, site=None):
+        '''Return spans for the text, reusing those already known.'''
+        if cls._cache.has(text):
+            spans = cls._cache.get(text)
+            if spans.site is site:
+                return spans
+        spans = cls(text, site)
+        cls._cache.set(text, spans)
+        return spans
+
+    def search(self, regex, index):
+        '''Return the span of regex.search(text, index) or None.'''
+        if index >= self._missing.get(regex, len(self.text) + 1):
+            return None
+        starts, ends, lows = self._found.setdefault(regex, ([], [], []))
+        i = bisect_left(starts, index)
+        if i < len(starts) and lows[i] <= index:
+            return starts[i], ends[i]
+
+        match = regex.search(self.text, index)
+        if match is None:
+            self._missing[regex] = index
+            return None
+        # no match starts between index and the next known match
+        if i < len(starts) and starts[i] == match.start():
+            lows[i] = index
+        else:
+            starts.insert(i, match.start())
+            ends.insert(i, match.end())
+            lows.insert(i, index)
+        return match.span()
+
+    def _expand(self, new, match):
+        # like textlib.replaceExcept, only expand group references
+        new = new.replace('\\n', '\n')
+        replacement = ''
+        last = 0
+        for group_match in self.groupR.finditer(new):
+            group_id = group_match[1] or group_match[2]
+            if group_id.isdigit():
+                group_id = int(group_id)
+            replacement += new[last:group_match.start()]
+            replacement += match.group(group_id) or ''
+            last = group_match.end()
+        return replacement + new[last:]
+
+    def replace(self, old, new, exceptions, count=0):
+        '''
+        Replace like textlib.replaceExcept and return the new text.
+
+        The text is searched again after each replacement from where
+        the replacement ends, as well as exceptions, so expressions
+        see the same context as with textlib.replaceExcept.
+        '''
+        text = self.text
+        if isinstance(old, str):
+            old = re.compile(old)
+        if not old.search(text):
+            return text
+
+        regexes = get_regexes(exceptions, self.site)
+        spans = self
+        index = replaced = 0
+        while not count or replaced < count:
+            if index > len(text):
+                break
+            match = old.search(text, index)
+            if not match:
+                break
+
+            # skip the exception which occurs next if it is before the match
+            next_span = None
+            for regex in regexes:
+                span = spans.search(regex, index)
+                if span and (next_span is None or span[0] < next_span[0]):
+                    next_span = span
+            if next_span is not None and next_span[0] <= match.start():
+                index = next_span[1]
+                continue
+
+            if callable(new):
+                replacement = new(match)
+            else:
+                replacement = self._expand(new, match)
+            if replacement != match.group():
+                text = text[:match.start()] + replacement + text[match.end():]
+                spans = self.__class__(text, self.site)
+            index = match.start() + len(replacement)
+            if not match.group():
+                index += 1
+            replaced += 1
+
+        if spans is not self:
+            self._cache.set(text, spans)
+        return text
+
+
+def replace_except(text, old, new, exceptions, site=None, count=0):
+    '''
+    Replace like textlib.replaceExcept but share searches for exceptions.
+
+    The result is the same as that of textlib.replaceExcept, calls on
+    the same text search for each exception from each index only once.
+    '''
+    return ProtectedSpans.of(text, site).replace(old, new, exceptions, count)
+
+
+def _strip_code(wikicode):
+    return ''.join(str(node) for node in wikicode.nodes if not isinstance(
+        node, mwparserfromhell.nodes.Comment)).strip()
+
+
+class WikitextDocument:
+
+    '''
+    Wikitext parsed once and shared by all fixes working on the same text
+
+    Parts of the document are extracted lazily on first access. A fix
+    that modifies the parse tree takes it with edit(), so that the
+    document does not keep a tree out of sync with its text when the fix
+    fails, and gets the new text from derive(), which hands the tree
+    over to the document of the new text, so the next fix does not need
+    to parse it again.
+    '''
+
+    _cache = LRUCache(4)
+
+    def __init__(self, text, site=None) -> None:
+        self.text = text
+        self.site = site
+        self._code = None
+        self._parts = {}
+
+    @classmethod
+    def of(cls, text, site=None):
+        '''Return the document for the text, reusing the parsed one.'''
+        if cls._cache.has(text):
+            doc = cls._cache.get(text)
+            if doc.site is site:
+                return doc
+        doc = cls(text, site)
+        cls._cache.set(text, doc)
+        return doc
+
+    @property
+    def code(self):
+        '''Parse tree of the text, it must not be modified, see edit().'''
+        if self._code is None:
+            self._code = mwparserfromhell.parse(
+                self.text, skip_style_tags=True)
+        return self._code
+
+    def edit(self):
+        '''Take the parse tree to be modified and passed to derive().'''
+        code = self.code
+        self._code = None
+        return code
+
+    def derive(self, code):
+        '''Return the text of the parse tree modified after edit().'''
+        text = str(code)
+        if text == self.text:
+            self._code = code
+        else:
+            # the tree now belongs to the new text
+            doc = type(self)(text, self.site)
+            doc._code = code
+            self._cache.set(text, doc)
+        return text
+
+    def _part(self, name, func):
+        if name not in self._parts:
+            self._parts[name] = func()
+        return self._parts[name]
+
+    @property
+    def templates(self):
+        '''
+        Templates with their parameters like page.raw_extracted_templates.
+
+        This follows textlib.extract_templates_and_params(text, False, True)
+        on the shared parse tree, which the library cannot take.
+        '''
+        def extract():
+            result = []
+            for template in self.code.ifilter_templates(
+                    recursive=True,
+                    matches=lambda t: not t.name.lstrip().startswith('#')):
+                params = OrderedDict()
+                for param in template.params:
+                    # values of implicit parameters are not stripped
+                    if param.showkey:
+                        params[param.name.strip()] = param.value.strip()
+                    else:
+                        params[param.name.strip()] = str(param.value)
+                result.append((template.name.strip(), params))
+            return result
+        return self._part('templates', extract)
+
+    @property
+    def headings(self):
+        '''Titles and levels of section headings.'''
+        return self._part('headings', lambda: [
+            (_strip_code(heading.title), heading.level)
+            for heading in self.code.ifilter_headings(recursive=False)])
+
+    @property
+    def links(self):
+        '''Targets of wikilinks, including category links.'''
+        return self._part('links', lambda: [
+            str(link.title).strip()
+            for link in self.code.ifilter_wikilinks(recursive=True)])
+
+    @property
+    def categories(self):
+        '''Category links, the list and its members may be modified.'''
+        categories = self._part('categories', lambda: textlib.getCategoryLinks(
+            self.text, site=self.site))
+        return [pywikibot.Category(category, sort_key=category.sortKey)
+                for category in categories]
+
+    def matches(self, regex):
+        '''Return all matches of the compiled regex in the text.'''
+        return self._part(regex, lambda: list(regex.finditer(self.text)))
+
+
+def _iter_json_dump(filename):
+    if filename.endswith('.bz2'):
+        file = bz2.open(filename, 'rt', encoding='utf-8')
+    elif filename.endswith('.gz'):
+        file = gzip.open(filename, 'rt', encoding='utf-8')
+    else:
+        file = open(filename, encoding='utf-8')
+    with file:
+        for line in file:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if 'article_body' in data:  # Wikimedia Enterprise format
+                yield DumpEntry(
+                    data['name'],
+                    data['namespace']['identifier'],
+                    data['article_body'].get('wikitext', ''),
+                    data.get('date_modified'),
+                    bool(data.get('redirects_to')))
+            else:
+                yield DumpEntry(
+                    data['title'],
+                    data.get('ns', 0),
+                    data.get('text', ''),
+                    data.get('timestamp'),
+                    bool(data.get('redirect')))
+
+
+def iter_dump_pages(filename, namespaces=None, redirects=False):
+    '''
+    Stream pages from a local XML or JSON lines dump.
+
+    Compressed dumps are read as a stream, nothing is loaded from the wiki.
+    '''
+    if '.json' in filename:
+        entries = _iter_json_dump(filename)
+    else:
+        entries = (DumpEntry(entry.title, int(entry.ns), entry.text,
+                             entry.timestamp, entry.isredirect)
+                   for entry in xmlreader.XmlDump(filename).parse())
+
+    for entry in entries:
+        if namespaces is not None and entry.ns not in namespaces:
+            continue
+        if entry.isredirect and not redirects:
+            continue
+        yield entry
+
+
 def deduplicate(arg):
     # todo: merge with filter_unique?
     for index, member in enumerate(arg, start=1):
@@ -69,8 +579,9 @@ def deduplicate(arg):
 def parse_image(text, site):
     # TODO: merge with .migrate_infobox.InfoboxMigratingBot.handle_image
     image = caption = None
-    imgR = re.compile(r'\[\[\s*(?:%s) *:' % '|'.join(site.namespaces[6]),
-                      flags=re.I)
+    imgR = RegexRegistry.get(
+        site, 'file-link',
+        lambda: r'\[\[\s*(?:%s) *:' % '|'.join(site.namespaces[6]), re.I)
     if imgR.match(text):
         split = text.rstrip()[:-2].split('|')
         matchR = FileRegexHolder.get_regex(site)
@@ -1,9 +1,24 @@
+import json
+import multiprocessing
+import os
 import re
 import time
 
+from contextlib import suppress
+from hashlib import md5
+
 import pywikibot
 
-from pywikibot import textlib
+from pywikibot import config, textlib
+
+from tools import (
+    LiteralMatcher,
+    changed_span,
+    fold_case,
+    get_regexes,
+    replace_except,
+    required_literals,
+)
 
 
 class IncompleteTypoRuleException(Exception):
@@ -47,12 +62,38 @@ class TypoRule:
 
     nowikiR = re.compile('</?nowiki>')
 
+    profile = None
+
     def __init__(self, find, replacements, auto=False, query=None):
         self.find = find
         self.replacements = replacements
         self.auto = auto
         self.query = query
         self.longest = 0
+        self._literals = False
+
+    @property
+    def key(self):
+        '''Identify the rule across changes of the typo page.'''
+        return self._source[0]
+
+    @property
+    def find(self):
+        if self._find is None:
+            self._find = re.compile(*self._source)
+        return self._find
+
+    @find.setter
+    def find(self, value):
+        self._find = value
+        if value is not None:
+            self._source = (value.pattern, value.flags)
+
+    @property
+    def literals(self):
+        if self._literals is False:
+            self._literals = required_literals(*self._source)
+        return self._literals
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -110,71 +151,513 @@ class TypoRule:
 
         return cls(find, replacements, auto, query)
 
+    @classmethod
+    def newFromDict(cls, data):
+        # the expression is only compiled when needed
+        rule = cls(None, data['replacements'], data['auto'], data['query'])
+        rule._source = (data['find'], data['flags'])
+        rule._literals = data['literals']
+        rule.longest = data['longest']
+        rule.id = data['id']
+        return rule
+
+    def toDict(self):
+        pattern, flags = self._source
+        return {
+            'id': self.id,
+            'find': pattern,
+            'flags': flags,
+            'replacements': self.replacements,
+            'auto': self.auto,
+            'query': self.query,
+            'literals': self.literals,
+            'longest': self.longest,
+        }
+
+    @staticmethod
+    def _underscores(string):
+        if string.startswith(' '):
+            string = '_' + string[1:]
+        if string.endswith(' '):
+            string = string[:-1] + '_'
+        return string
+
+    def choose(self, text, start, end, replacements):
+        '''Let the user choose a replacement of text[start:end].'''
+        old = text[start:end]
+        options = [('keep', 'k')]
+        for i, replacement in enumerate(replacements, start=1):
+            options.append(
+                (f'{i} {self._underscores(replacement)}', str(i)))
+        pre = text[max(0, start - 30):start].rpartition('\n')[2]
+        post = text[end:end + 30].partition('\n')[0]
+        pywikibot.info(f'{pre}<<lightred>>{old}<<default>>{post}')
+        choice = pywikibot.input_choice('Choose the best replacement',
+                                        options, automatic_quit=False,
+                                        default='k')
+        if choice != 'k':
+            return replacements[int(choice) - 1]
+        return old
+
+    def record(self, old, new, replaced):
+        '''Add the replacement to the summary fragments in replaced.'''
+        if old == new:
+            if not self.needs_decision():
+                pywikibot.warning(f'No replacement done in string "{old}"')
+            return
+        old_str = self._underscores(old.replace('\n', '\\n'))
+        new_str = self._underscores(new.replace('\n', '\\n'))
+        fragment = f'{old_str} → {new_str}'
+        if fragment.lower() not in map(str.lower, replaced):
+            replaced.append(fragment)
+
     def summary_hook(self, match, replaced):
-        def underscores(string):
-            if string.startswith(' '):
-                string = '_' + string[1:]
-            if string.endswith(' '):
-                string = string[:-1] + '_'
-            return string
-
-        new = old = match.group()
+        old = match.group()
         if self.needs_decision():
-            options = [('keep', 'k')]
-            replacements = []
-            for i, repl in enumerate(self.replacements, start=1):
-                replacement = match.expand(repl)
-                replacements.append(replacement)
-                options.append((f'{i} {underscores(replacement)}', str(i)))
-            text = match.string
-            pre = text[max(0, match.start() - 30):match.start()].rpartition('\n')[2]
-            post = text[match.end():match.end() + 30].partition('\n')[0]
-            pywikibot.info(f'{pre}<<lightred>>{old}<<default>>{pos}')
-            choice = pywikibot.input_choice('Choose the best replacement',
-                                            options, automatic_quit=False,
-                                            default='k')
-            if choice != 'k':
-                new = replacements[int(choice) - 1]
+            new = self.choose(
+                match.string, match.start(), match.end(),
+                [match.expand(repl) for repl in self.replacements])
         else:
             new = match.expand(self.replacements[0])
-            if old == new:
-                pywikibot.warning(f'No replacement done in string "{old}"')
-
-        if old != new:
-            old_str = underscores(old.replace('\n', '\\n'))
-            new_str = underscores(new.replace('\n', '\\n'))
-            fragment = f'{old_str} → {new_str}'
-            if fragment.lower() not in map(str.lower, replaced):
-                replaced.append(fragment)
+        self.record(old, new, replaced)
         return new
 
-    def apply(self, text, replaced=None):
+    def apply_result(self, text, result, replaced):
+        '''Return the text with the result of the sandbox applied.'''
+        new_text, found = result
+        if not self.needs_decision():
+            for old, new in found:
+                self.record(old, new, replaced)
+            return text if new_text is None else new_text
+
+        # matches were found in the text without the user's replacements
+        pieces = []
+        last = 0
+        for start, end, replacements in found:
+            new = self.choose(text, start, end, replacements)
+            self.record(text[start:end], new, replaced)
+            pieces.append(text[last:start])
+            pieces.append(new)
+            last = end
+        pieces.append(text[last:])
+        return ''.join(pieces)
+
+    def apply(self, text, replaced=None, sandbox=None):
         if replaced is None:
             replaced = []
-        hook = lambda match: self.summary_hook(match, replaced)
-        start = time.clock()
-        text = textlib.replaceExcept(
-            text, self.find, hook, self.exceptions, site=self.site)
-        finish = time.clock()
+        start = time.perf_counter()
+        if sandbox is not None:
+            result = sandbox.run(self, text)
+            if result is None:
+                pywikibot.warning(
+                    f'Typo rule "{self.find.pattern}" timed out after '
+                    f'{sandbox.timeout}s, skipping')
+                if self.profile is not None:
+                    self.profile.record_timeout(self, len(text))
+                return text
+            new_text = self.apply_result(text, result, replaced)
+        else:
+            hook = lambda match: self.summary_hook(match, replaced)
+            new_text = replace_except(
+                text, self.find, hook, self.exceptions, site=self.site)
+        finish = time.perf_counter()
         delta = finish - start
         self.longest = max(delta, self.longest)
+        if self.profile is not None:
+            self.profile.record(self, delta, new_text != text)
+        text = new_text
         if delta > 5:
             pywikibot.warning(f'Slow typo rule "{self.find.pattern}" ({delta})')
         return text
 
 
+class TypoPrefilter:
+
+    '''
+    Class selecting typo rules which can possibly match a text
+
+    Each rule is indexed by literals required by its expression, so that
+    the text is scanned only once to find candidates for the expensive
+    replacement. Rules without such literals are always candidates.
+    '''
+
+    def __init__(self, rules):
+        self.always = set()
+        owners = {}
+        for rule in rules:
+            literals = rule.literals
+            if not literals:
+                self.always.add(rule.id)
+                continue
+            for literal in literals:
+                owners.setdefault(literal, []).append(rule.id)
+        self.owners = list(owners.values())
+        self.matcher = LiteralMatcher(owners.keys())
+
+    def candidates(self, text):
+        '''Return ids of rules which can match the text.'''
+        found = set(self.always)
+        for index in self.matcher.search(fold_case(text)):
+            found.update(self.owners[index])
+        return found
+
+    def update(self, candidates, old_text, new_text):
+        '''
+        Return candidates for the new text given those of the old text.
+
+        Only the changed part of the text is scanned, so the result may
+        contain rules which could only match the removed text.
+        '''
+        start, _, end = changed_span(old_text, new_text)
+        # literals overlapping the change
+        margin = self.matcher.longest
+        changed = new_text[max(0, start - margin):end + margin]
+        return candidates | self.candidates(changed)
+
+
+def _sandbox_replace(text, regex, replacements, decide, exceptions):
+    found = []
+    if decide:
+        # only collect matches, the user chooses replacements later
+        def hook(match):
+            found.append((match.start(), match.end(),
+                          [match.expand(repl) for repl in replacements]))
+            return match.group()
+    else:
+        def hook(match):
+            new = match.expand(replacements[0])
+            found.append((match.group(), new))
+            return new
+
+    new_text = replace_except(text, regex, hook, exceptions)
+    return new_text, found
+
+
+def _sandbox_worker(conn, exceptions):
+    compiled = {}
+    text = ''
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        source, replacements, decide, new_text = message
+        if new_text is not None:
+            text = new_text
+        if source not in compiled:
+            compiled[source] = re.compile(*source)
+        result, found = _sandbox_replace(
+            text, compiled[source], replacements, decide, exceptions)
+        if result == text:
+            conn.send((None, found))
+        else:
+            text = result
+            conn.send((result, found))
+
+
+class RuleSandbox:
+
+    '''
+    Class guarding typo rules against catastrophic backtracking
+
+    Rules are applied in a worker process, which returns the new text
+    and the replacements done. When a rule does not finish in time,
+    the worker is killed (and restarted for the next rule) and the rule
+    is skipped.
+
+    Rules which need the user's decision only collect their matches
+    in the worker, these are found in the text without replacements
+    chosen for previous matches.
+    '''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.process = None
+        self.text = None
+
+    def start(self, rule):
+        # compiled expressions can be sent to the worker, the site cannot
+        exceptions = get_regexes(rule.exceptions, rule.site)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_sandbox_worker, args=(child_conn, exceptions),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.text = None
+
+    def stop(self):
+        if self.process is None:
+            return
+        with suppress(OSError):
+            self.conn.send(None)
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+        self.process = None
+
+    def run(self, rule, text):
+        '''
+        Apply the rule to the text in the worker.
+
+        Return the new text (None when unchanged) and the replacements,
+        or None when the rule did not finish in time.
+        '''
+        if self.process is None:
+            self.start(rule)
+        # send the text only when the worker does not have it
+        new_text = None if text is self.text else text
+        self.conn.send((rule._source, rule.replacements,
+                        rule.needs_decision(), new_text))
+        self.text = text
+        if self.conn.poll(self.timeout):
+            result = self.conn.recv()
+            if result[0] is not None:
+                # the worker continues with the new text
+                self.text = result[0]
+            return result
+
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.process = None
+        return None
+
+
+class TypoProfile:
+
+    '''
+    Class holding performance of typo rules across runs
+
+    For each rule, it keeps how many pages it was applied on, how many of
+    them it changed, recent apply times and accuracy of its search query.
+    Quarantined rules are probed again after some days with their
+    samples forgotten.
+    '''
+
+    max_samples = 100
+    max_timeouts = 2
+    # characters, timeouts on longer texts are not held against the rule
+    max_text_length = 300000
+    min_samples = 5
+    quarantine_days = 7
+    quarantine_time = 5.0  # seconds, p95
+    slow_time = 0.5  # seconds, p95
+
+    def __init__(self, site):
+        self.site = site
+        self.data = {}
+
+    @property
+    def path(self):
+        return config.datafilepath(
+            'typos', f'{self.site.dbName()}-profile.json')
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        return self
+
+    def save(self):
+        path = self.path
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def reset(self):
+        self.data = {}
+
+    def prune(self, rules):
+        '''Forget rules which are not among rules.'''
+        keys = {rule.key for rule in rules}
+        for key in set(self.data) - keys:
+            del self.data[key]
+
+    def entry(self, rule):
+        return self.data.setdefault(rule.key, {
+            'pages': 0, 'matches': 0, 'times': [], 'max': 0.0,
+            'processed': 0, 'replaced': 0, 'timeouts': 0,
+        })
+
+    def record(self, rule, delta, matched):
+        entry = self.entry(rule)
+        entry['pages'] += 1
+        entry['matches'] += int(matched)
+        entry['max'] = max(entry['max'], delta)
+        times = entry['times']
+        times.append(round(delta, 4))
+        del times[:-self.max_samples]
+
+    def record_timeout(self, rule, length=0):
+        if length <= self.max_text_length:
+            self.entry(rule)['timeouts'] += 1
+
+    def record_query(self, rule, processed, replaced):
+        entry = self.entry(rule)
+        entry['processed'] += processed
+        entry['replaced'] += replaced
+
+    def percentile(self, rule, percent):
+        times = sorted(self.data.get(rule.key, {}).get('times', []))
+        if len(times) < self.min_samples:
+            return None
+        return times[int(percent / 100 * (len(times) - 1))]
+
+    def accuracy(self, rule):
+        entry = self.data.get(rule.key)
+        if not entry or not entry['processed']:
+            return None
+        return entry['replaced'] / entry['processed']
+
+    def is_quarantined(self, rule):
+        entry = self.data.get(rule.key)
+        if entry and entry['timeouts'] >= self.max_timeouts:
+            return True
+        p95 = self.percentile(rule, 95)
+        return p95 is not None and p95 >= self.quarantine_time
+
+    def is_slow(self, rule):
+        p95 = self.percentile(rule, 95)
+        return p95 is not None and p95 >= self.slow_time
+
+    def reprobe(self, rule):
+        entry = self.entry(rule)
+        entry['times'] = []
+        entry['timeouts'] = 0
+        entry.pop('quarantined', None)
+
+    def order(self, rules):
+        '''Skip pathological rules and move slow rules to the end.'''
+        now = time.time()
+        fast = []
+        slow = []
+        for rule in rules:
+            if self.is_quarantined(rule):
+                since = self.entry(rule).setdefault('quarantined', now)
+                if now - since < self.quarantine_days * 86400:
+                    pywikibot.warning(f'Skipped quarantined rule "{rule.key}"')
+                    continue
+                pywikibot.info(f'Probing quarantined rule "{rule.key}" again')
+                self.reprobe(rule)
+            elif rule.key in self.data:
+                self.data[rule.key].pop('quarantined', None)
+            if self.is_slow(rule):
+                slow.append(rule)
+            else:
+                fast.append(rule)
+        return fast + slow
+
+    def report(self, rules, limit=100):
+        '''Return a wikitext table of the slowest rules.'''
+        rows = []
+        for rule in rules:
+            p95 = self.percentile(rule, 95)
+            if p95 is None:
+                continue
+            entry = self.data[rule.key]
+            accuracy = self.accuracy(rule)
+            rows.append((p95, [
+                '<nowiki>{}</nowiki>'.format(rule.key),
+                str(entry['pages']),
+                str(entry['matches']),
+                '{:.3f}'.format(self.percentile(rule, 50)),
+                f'{p95:.3f}',
+                '{:.3f}'.format(entry['max']),
+                '' if accuracy is None else f'{accuracy:.0%}',
+            ]))
+        rows.sort(key=lambda row: row[0], reverse=True)
+        lines = [
+            '{| class="wikitable sortable"',
+            '! Pravidlo !! Stránek !! Shod !! p50 (s) !! p95 (s) !! max (s) '
+            '!! Přesnost dotazu',
+        ]
+        for _, cells in rows[:limit]:
+            lines.append('|-')
+            lines.append('| ' + ' || '.join(cells))
+        lines.append('|}')
+        return '\n'.join(lines)
+
+
+class TypoCheckpoint:
+
+    '''
+    Class holding the state of the last incremental typo run
+
+    It remembers until when recent changes have been scanned and which
+    rules were known at that time, so that new and changed rules can be
+    told apart.
+    '''
+
+    def __init__(self, site):
+        self.site = site
+        self.data = {}
+
+    @property
+    def path(self):
+        return config.datafilepath(
+            'typos', f'{self.site.dbName()}-checkpoint.json')
+
+    @property
+    def timestamp(self):
+        value = self.data.get('timestamp')
+        if value:
+            return pywikibot.Timestamp.fromISOformat(value)
+        return None
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        return self
+
+    def save(self):
+        path = self.path
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.data, f)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def signature(rule):
+        data = json.dumps(
+            [rule.key, rule.replacements, rule.auto], ensure_ascii=False)
+        return md5(data.encode()).hexdigest()
+
+    def changed(self, rules):
+        known = set(self.data.get('rules', []))
+        return [rule for rule in rules if self.signature(rule) not in known]
+
+    def update(self, timestamp, rules):
+        self.data = {
+            'timestamp': timestamp.isoformat(),
+            'rules': sorted({self.signature(rule) for rule in rules}),
+        }
+
+
 class TyposLoader:
 
+    cache_version = 3
     top_id = 0
 
     '''Class loading and holding typo rules'''
 
     def __init__(self, site, *, allrules=False, typospage=None,
-                 whitelistpage=None):
+                 whitelistpage=None, cache=True, profile=True):
         self.site = site
         self.load_all = allrules
         self.typos_page_name = typospage
         self.whitelist_page_name = whitelistpage
+        self.use_cache = cache
+        self.revision = None
+        self.allRules = []
+        self.profile = TypoProfile(site).load() if profile else None
 
     def getWhitelistPage(self):
         if self.whitelist_page_name is None:
@@ -182,20 +665,46 @@ class TyposLoader:
 
         return pywikibot.Page(self.site, self.whitelist_page_name)
 
+    def getTyposPage(self):
+        if self.typos_page_name is None:
+            self.typos_page_name = 'Wikipedie:WPCleaner/Typo'
+
+        return pywikibot.Page(self.site, self.typos_page_name)
+
     def loadTypos(self):
         pywikibot.info('Loading typo rules...')
         self.typoRules = []
 
-        if self.typos_page_name is None:
-            self.typos_page_name = 'Wikipedie:WPCleaner/Typo'
-        typos_page = pywikibot.Page(self.site, self.typos_page_name)
+        typos_page = self.getTyposPage()
         if not typos_page.exists():
             # todo: feedback
+            self.prefilter = TypoPrefilter(self.typoRules)
             return
 
-        text = textlib.removeDisabledParts(
-            typos_page.text, include=['nowiki'], site=self.site)
+        self.revision = typos_page.latest_revision_id
+        if not (self.use_cache and self.loadCache()):
+            self.allRules = self.parseTypos(typos_page.text)
+            if self.use_cache:
+                self.saveCache()
+
         load_all = self.load_all is True
+        for rule in self.allRules:
+            rule.site = self.site
+            rule.profile = self.profile
+            if load_all or not rule.needs_decision():
+                self.typoRules.append(rule)
+
+        if self.profile is not None:
+            self.profile.prune(self.allRules)
+            self.typoRules = self.profile.order(self.typoRules)
+        self.prefilter = TypoPrefilter(self.typoRules)
+        pywikibot.info(f'{len(self.typoRules)} typo rules loaded')
+        return self.typoRules
+
+    def parseTypos(self, text):
+        rules = []
+        text = textlib.removeDisabledParts(
+            text, include=['nowiki'], site=self.site)
         for template, fielddict in textlib.extract_templates_and_params(
                 text, remove_disabled_parts=False, strip=False):
             if template.lower() == 'typo':
@@ -211,11 +720,61 @@ class TyposLoader:
                     rule.id = self.top_id
                     # fixme: cvar or ivar?
                     self.top_id += 1
-                    if load_all or not rule.needs_decision():
-                        self.typoRules.append(rule)
+                    rules.append(rule)
+        return rules
+
+    def searchIndex(self, rules, namespaces=(0,)):
+        '''Run queries of the rules and map titles found to the rules.'''
+        index = {}
+        titles_by_query = {}
+        for rule in rules:
+            if rule.query is None:
+                continue
+            if rule.query not in titles_by_query:
+                pywikibot.info(f'Query: "{rule.query}"')
+                titles_by_query[rule.query] = [
+                    page.title() for page in self.site.search(
+                        rule.query, namespaces=namespaces)]
+            for title in titles_by_query[rule.query]:
+                index.setdefault(title, []).append(rule)
+
+        pywikibot.info(f'{len(index)} distinct pages found')
+        return index
+
+    @property
+    def cache_path(self):
+        title_hash = md5(self.typos_page_name.encode()).hexdigest()[:8]
+        return config.datafilepath(
+            'typos', f'{self.site.dbName()}-{title_hash}.json')
+
+    def loadCache(self):
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
 
-        pywikibot.info(f'{len(self.typoRules)} typo rules loaded')
-        return self.typoRules
+        if data.get('version') != self.cache_version:
+            return False
+        if data.get('revision') != self.revision:
+            pywikibot.info('Typo rules changed since the last run')
+            return False
+
+        self.allRules = [TypoRule.newFromDict(rule) for rule in data['rules']]
+        self.top_id = max((rule.id + 1 for rule in self.allRules), default=0)
+        return True
+
+    def saveCache(self):
+        '''Store parsed rules and their timing for the next run.'''
+        data = {
+            'version': self.cache_version,
+            'revision': self.revision,
+            'rules': [rule.toDict() for rule in self.allRules],
+        }
+        path = self.cache_path
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
 
     def loadWhitelist(self):
         self.whitelist = []
@@ -1,10 +1,12 @@
 #!/usr/bin/python
 import time
 
+from datetime import timedelta
+
 import pywikibot
 from pywikibot import pagegenerators
 
-from typoloader import TyposLoader
+from typoloader import RuleSandbox, TypoCheckpoint, TyposLoader
 from wikitext import WikitextFixingBot
 
 
@@ -15,9 +17,16 @@ class TypoBot(WikitextFixingBot):
 
     Supported parameters:
     * -allrules - use if you want to load rules that need user's decision
+    * -incremental - only check pages edited since the last incremental run
+      and search for rules which are new or changed since then
     * -offset:# - what typo rule do you want to start from
+    * -profilepage: - where to save the report of slow rules
     * -quick - use if you want the bot to focus on the current rule,
       ie. skip the page if the rule couldn't be applied
+    * -resetprofile - forget performance of rules from previous runs,
+      including quarantined rules
+    * -ruletimeout:# - skip rule on page if it runs longer than # seconds
+      (0 to disable)
     * -threshold:# - skip rule when loaded/replaced ratio gets over #
     * -typospage: - what page do you want to load typo rules from
     * -whitelistpage: - what page holds pages which should be skipped
@@ -26,7 +35,11 @@ class TypoBot(WikitextFixingBot):
     def __init__(self, generator, *, offset=0, **kwargs):
         self.available_options.update({
             'allrules': False,
+            'incremental': False,
+            'profilepage': None,
             'quick': False,
+            'resetprofile': False,
+            'ruletimeout': 10,
             'threshold': 10,
             'typospage': None,
             'whitelistpage': None,
@@ -42,13 +55,28 @@ class TypoBot(WikitextFixingBot):
         self.offset = offset
 
     def setup(self):
+        if self.own_generator and self.opt['prefetch']:
+            # the generator follows the progress of the current rule
+            pywikibot.warning('Cannot prefetch pages of typo rule queries')
+            self.opt['prefetch'] = 0
+        super().setup()
         loader = TyposLoader(
             self.site, allrules=self.opt['allrules'],
             typospage=self.opt['typospage'],
             whitelistpage=self.opt['whitelistpage'])
+        if self.opt['resetprofile'] and loader.profile is not None:
+            loader.profile.reset()
         self.typoRules = loader.loadTypos()
+        self.loader = loader
+        self.prefilter = loader.prefilter
         self.fp_page = loader.getWhitelistPage()
         self.whitelist = loader.loadWhitelist()
+        self.checkpoint = None
+        if self.own_generator and self.opt['incremental']:
+            self.checkpoint = TypoCheckpoint(self.site).load()
+        self.sandbox = None
+        if self.opt['ruletimeout']:
+            self.sandbox = RuleSandbox(self.opt['ruletimeout'])
 
     @property
     def is_rule_accurate(self):
@@ -58,14 +86,53 @@ class TypoBot(WikitextFixingBot):
         return result
 
     def make_generator(self):
-        for i, rule in enumerate(self.typoRules[:]):
-            if self.offset > i:
+        if self.opt['incremental']:
+            yield from self.incremental_generator()
+        else:
+            yield from self.rules_generator(self.typoRules, self.offset)
+
+    def incremental_generator(self):
+        # recent changes older than this are usually gone
+        max_age = timedelta(days=30)
+        start = self.site.server_time()
+        since = self.checkpoint.timestamp
+        if since is None or start - since > max_age:
+            pywikibot.info('No usable checkpoint, searching for all rules')
+            rules = self.typoRules
+        else:
+            rules = self.checkpoint.changed(self.typoRules)
+            yield from self.recentchanges_generator(since)
+        pywikibot.info(f'\n{len(rules)} new or changed rules')
+        yield from self.rules_generator(rules)
+        self.new_checkpoint = start
+
+    def recentchanges_generator(self, since):
+        pywikibot.info(f'\nPages edited since {since}')
+        self.current_rule = None
+        self.skip_rule = False
+        self.processed = self.replaced = 0
+        seen = set()
+        changes = self.site.recentchanges(
+            start=since, reverse=True, namespaces=[0], redirect=False,
+            top_only=True)
+        for change in changes:
+            if change['type'] not in ('edit', 'new'):
+                continue
+            title = change['title']
+            if title not in seen:
+                seen.add(title)
+                yield pywikibot.Page(self.site, title)
+
+    def rules_generator(self, rules, offset=0):
+        for i, rule in enumerate(rules[:]):
+            if offset > i:
                 continue
             if rule.query is None:
                 continue
 
             # todo: if not allrules:...
-            self.offset = i
+            if not self.opt['incremental']:
+                self.offset = i
             pywikibot.info(f'\nQuery: "{rule.query}"')
             old_max = rule.longest
             rule.longest = 0.0
@@ -91,6 +158,9 @@ class TypoBot(WikitextFixingBot):
 
             if self.processed > 0:
                 pywikibot.info(f'Longest match: {rule.longest}s')
+                if self.loader.profile is not None:
+                    self.loader.profile.record_query(
+                        rule, self.processed, self.replaced)
             rule.longest = max(old_max, rule.longest)
 
     def save_false_positive(self, page):
@@ -104,7 +174,8 @@ class TypoBot(WikitextFixingBot):
             pywikibot.warning(f'Skipped {page} because it is whitelisted')
             return True
 
-        if self.own_generator and self.current_rule.find.search(page.title()):
+        if (self.own_generator and self.current_rule is not None
+                and self.current_rule.find.search(page.title())):
             pywikibot.warning(
                 f'Skipped {page} because the rule matches the title')
             return True
@@ -123,8 +194,9 @@ class TypoBot(WikitextFixingBot):
         done_replacements = []
         quickly = self.opt['quick'] is True
         start = time.time()
-        if self.own_generator:
-            text = self.current_rule.apply(page.text, done_replacements)
+        if self.own_generator and self.current_rule is not None:
+            text = self.current_rule.apply(
+                page.text, done_replacements, self.sandbox)
             if page.text == text:
                 if quickly:
                     pywikibot.info('Typo not found, not fixing another '
@@ -133,7 +205,10 @@ class TypoBot(WikitextFixingBot):
             else:
                 self.replaced += 1
 
+        candidates = self.prefilter.candidates(text)
         for rule in self.typoRules:
+            if rule.id not in candidates:
+                continue
             if self.own_generator and rule == self.current_rule:  # __eq__
                 continue
             if rule.find.search(page.title()):
@@ -141,7 +216,11 @@ class TypoBot(WikitextFixingBot):
             if quickly and rule.needs_decision():
                 continue
 
-            text = rule.apply(text, done_replacements)
+            new_text = rule.apply(text, done_replacements, self.sandbox)
+            if new_text != text:
+                # replacements may have introduced matches of other rules
+                candidates = self.prefilter.update(candidates, text, new_text)
+                text = new_text
             stop = time.time()
             if quickly and stop - start > 15:
                 pywikibot.warning('Other typos exceeded 15s, skipping')
@@ -157,7 +236,7 @@ class TypoBot(WikitextFixingBot):
         options = [('yes', 'y'), ('no', 'n'), ('all', 'a')]
         if self.fp_page.exists():
             options.append(('false positive', 'f'))
-        if self.own_generator:
+        if self.own_generator and self.current_rule is not None:
             options.append(('skip rule', 's'))
         options += [('open in browser', 'b'), ('quit', 'q')]
 
@@ -194,8 +273,23 @@ class TypoBot(WikitextFixingBot):
         pywikibot.info('\nSlowest autonomous rules:')
         for i, rule in enumerate(rules, start=1):
             pywikibot.info(f'{i}. "{rule.find.pattern}" - {rule.longest}')
-        if self.own_generator:
+        if self.own_generator and not self.opt['incremental']:
             pywikibot.info(f'\nCurrent offset: {self.offset}\n')
+        if self.checkpoint is not None and self.generator_completed:
+            self.checkpoint.update(self.new_checkpoint, self.typoRules)
+            self.checkpoint.save()
+        if self.sandbox is not None:
+            self.sandbox.stop()
+        if self.loader.use_cache and self.loader.revision:
+            self.loader.saveCache()
+        profile = self.loader.profile
+        if profile is not None:
+            profile.save()
+            if self.opt['profilepage']:
+                page = pywikibot.Page(self.site, self.opt['profilepage'])
+                page.text = profile.report(self.loader.allRules)
+                page.save(summary='aktualizace výkonu pravidel', minor=False,
+                          bot=False, apply_cosmetic_changes=False)
         super().teardown()
 
 
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+'''
+Offline benchmark of the typo engine
+
+First take a snapshot of the typo rules and of a corpus of articles:
+
+    python pwb.py typos_benchmark snapshot -dir:bench -random:500
+
+Then measure TyposLoader.loadTypos and TypoBot.treat_page on the snapshot,
+nothing is loaded from the wiki (apart from site info) or saved:
+
+    python pwb.py typos_benchmark -dir:bench -save
+
+Supported parameters:
+* -baseline: - file with results to compare with (default baseline.json
+  in the snapshot directory)
+* -dir: - directory of the snapshot
+* -dump: - snapshot: take the corpus from a local dump instead of the wiki
+* -pages:# - snapshot: how many pages to take (default 500)
+* -repeat:# - how many times to scan the corpus, the best time is kept
+* -ruletimeout:# - apply rules in a sandbox with this timeout like the bot
+  does (default 0, no sandbox)
+* -save - store the results as the new baseline
+* -tolerance:# - report a regression when a result is worse by more than
+  # percent (default 10)
+* -typospage: - snapshot: what page do you want to load typo rules from
+'''
+import json
+import os
+import time
+import tracemalloc
+
+from itertools import islice
+
+import pywikibot
+
+from pywikibot import pagegenerators
+
+from tools import iter_dump_pages
+from typoloader import RuleSandbox, TyposLoader
+from typos import TypoBot
+
+CORPUS = 'corpus.json'
+TYPOS = 'typos.txt'
+
+
+def take_snapshot(site, directory, generator, *, dump=None, pages=500,
+                  typospage=None):
+    os.makedirs(directory, exist_ok=True)
+    loader = TyposLoader(site, typospage=typospage, cache=False,
+                         profile=False)
+    typos_page = loader.getTyposPage()
+    with open(os.path.join(directory, TYPOS), 'w', encoding='utf-8') as f:
+        f.write(typos_page.text)
+
+    if dump:
+        entries = ((entry.title, entry.text)
+                   for entry in iter_dump_pages(dump, namespaces=[0]))
+    else:
+        if generator is None:
+            generator = site.randompages(namespaces=[0], redirects=False)
+        entries = ((page.title(), page.text)
+                   for page in pagegenerators.PreloadingGenerator(generator)
+                   if page.exists() and not page.isRedirectPage())
+
+    count = 0
+    with open(os.path.join(directory, CORPUS), 'w', encoding='utf-8') as f:
+        for title, text in islice(entries, pages):
+            json.dump({'title': title, 'text': text}, f, ensure_ascii=False)
+            f.write('\n')
+            count += 1
+    pywikibot.info(f'Saved {count} pages and rules from {typos_page}')
+
+
+class SnapshotPage(pywikibot.Page):
+
+    '''Page with the text from the snapshot, nothing is loaded'''
+
+    def __init__(self, source, text):
+        super().__init__(source)
+        self.text = text
+
+    def exists(self):
+        return True
+
+    @property
+    def latest_revision_id(self):
+        return None
+
+
+class SnapshotLoader(TyposLoader):
+
+    '''Loader of typo rules saved in the snapshot'''
+
+    def __init__(self, site, text):
+        super().__init__(site, cache=False, profile=False)
+        self.text = text
+
+    def getTyposPage(self):
+        return SnapshotPage(super().getTyposPage(), self.text)
+
+
+class CostProfile:
+
+    '''Collector of time spent in each rule, see TypoRule.apply'''
+
+    def __init__(self):
+        self.costs = {}
+
+    def record(self, rule, delta, matched):
+        self.costs[rule.key] = self.costs.get(rule.key, 0.0) + delta
+
+    def record_timeout(self, rule, length=0):
+        pass
+
+
+class BenchmarkBot(TypoBot):
+
+    '''TypoBot counting changed pages instead of saving them'''
+
+    _benchmark_page = None
+
+    @property
+    def current_page(self):
+        return self._benchmark_page
+
+    @current_page.setter
+    def current_page(self, page):
+        # without announcing each page
+        self._benchmark_page = page
+
+    def put_current(self, new_text, **kwargs):
+        if new_text != self.current_page.text:
+            self.changed += 1
+        return False
+
+    def scan(self, pages, profile):
+        for rule in self.typoRules:
+            rule.profile = profile
+        self.changed = 0
+        for page in pages:
+            self.current_page = page
+            self.treat_page()
+        return self.changed
+
+
+def run_benchmark(site, directory, *, repeat=3, ruletimeout=0):
+    with open(os.path.join(directory, TYPOS), encoding='utf-8') as f:
+        typos_text = f.read()
+    pages = []
+    for entry in iter_dump_pages(os.path.join(directory, CORPUS)):
+        page = pywikibot.Page(site, entry.title)
+        page.text = entry.text
+        pages.append(page)
+
+    loader = SnapshotLoader(site, typos_text)
+    start = time.perf_counter()
+    rules = loader.loadTypos()
+    load_time = time.perf_counter() - start
+
+    # the bot is set up like TypoBot.setup does, without the wiki
+    bot = BenchmarkBot(pages, site=site, always=True)
+    bot.loader = loader
+    bot.typoRules = rules
+    bot.prefilter = loader.prefilter
+    bot.current_rule = None
+    bot.sandbox = RuleSandbox(ruletimeout) if ruletimeout else None
+
+    try:
+        # a warm-up pass, expressions are compiled when first used
+        bot.scan(pages, CostProfile())
+
+        best = None
+        for _ in range(max(repeat, 1)):
+            profile = CostProfile()
+            start = time.perf_counter()
+            changed = bot.scan(pages, profile)
+            delta = time.perf_counter() - start
+            if best is None or delta < best[0]:
+                best = (delta, profile.costs)
+        scan_time, costs = best
+
+        # tracing slows down the scan, so it gets a pass of its own
+        tracemalloc.start()
+        bot.scan(pages, CostProfile())
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        if bot.sandbox is not None:
+            bot.sandbox.stop()
+
+    return {
+        'pages': len(pages),
+        'rules': len(rules),
+        'changed': changed,
+        'load_time': round(load_time, 4),
+        'scan_time': round(scan_time, 4),
+        'pages_per_second': round(len(pages) / scan_time, 2)
+        if scan_time else 0.0,
+        'peak_memory': peak_memory,
+        'costs': {key: round(cost, 6) for key, cost in costs.items()},
+    }
+
+
+def report(results, limit=10):
+    pywikibot.info(
+        f"{results['pages']} pages, {results['rules']} rules, "
+        f"{results['changed']} pages changed")
+    pywikibot.info(f"Loading rules: {results['load_time']:.3f}s")
+    pywikibot.info(
+        f"Scan: {results['scan_time']:.3f}s "
+        f"({results['pages_per_second']:.1f} pages/s)")
+    pywikibot.info(f"Peak memory: {results['peak_memory'] / 2**20:.1f} MiB")
+    pywikibot.info('\nMost expensive rules:')
+    costs = sorted(results['costs'].items(), key=lambda item: item[1],
+                   reverse=True)
+    for i, (key, cost) in enumerate(costs[:limit], start=1):
+        pywikibot.info(f'{i}. "{key}" - {cost:.4f}s')
+
+
+def compare(results, baseline, tolerance=10):
+    '''Return descriptions of results worse than in the baseline.'''
+    ratio = 1 + tolerance / 100
+    regressions = []
+    if results['pages_per_second'] * ratio < baseline['pages_per_second']:
+        regressions.append(
+            f"throughput {baseline['pages_per_second']:.1f} -> "
+            f"{results['pages_per_second']:.1f} pages/s")
+    for key, name in (('load_time', 'loading rules'),
+                      ('peak_memory', 'peak memory')):
+        if results[key] > baseline[key] * ratio:
+            regressions.append(f'{name} {baseline[key]} -> {results[key]}')
+
+    # ignore rules too cheap to be measured reliably
+    min_cost = 0.01 * results['scan_time']
+    for key, cost in results['costs'].items():
+        old = baseline['costs'].get(key)
+        if old is not None and cost > min_cost and cost > old * ratio:
+            regressions.append(f'rule "{key}" {old:.4f}s -> {cost:.4f}s')
+    return regressions
+
+
+def main(*args):
+    options = {}
+    snapshot = False
+    local_args = pywikibot.handle_args(args)
+    genFactory = pagegenerators.GeneratorFactory()
+    for arg in genFactory.handle_args(local_args):
+        if arg == 'snapshot':
+            snapshot = True
+        elif arg.startswith('-'):
+            arg, sep, value = arg.partition(':')
+            if value != '':
+                options[arg[1:]] = int(value) if value.isdigit() else value
+            else:
+                options[arg[1:]] = True
+
+    site = pywikibot.Site()
+    directory = options.get('dir', 'typos-benchmark')
+    if snapshot:
+        take_snapshot(
+            site, directory, genFactory.getCombinedGenerator(),
+            dump=options.get('dump'), pages=options.get('pages', 500),
+            typospage=options.get('typospage'))
+        return
+
+    results = run_benchmark(site, directory, repeat=options.get('repeat', 3),
+                            ruletimeout=options.get('ruletimeout', 0))
+    report(results)
+
+    baseline_path = options.get(
+        'baseline', os.path.join(directory, 'baseline.json'))
+    regressions = []
+    try:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        pywikibot.info(f'\nNo baseline in {baseline_path}')
+    else:
+        regressions = compare(results, baseline, options.get('tolerance', 10))
+        if regressions:
+            pywikibot.warning('Regressions against the baseline:\n'
+                              + '\n'.join(regressions))
+        else:
+            pywikibot.info('\nNo regressions against the baseline')
+
+    if options.get('save'):
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+        pywikibot.info(f'Baseline saved to {baseline_path}')
+
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,12 @@
 #!/usr/bin/python
+import difflib
+import gzip
+import json
+import multiprocessing
+import os
+import time
+
+from collections import Counter, deque
 from itertools import chain
 from operator import methodcaller
 
@@ -6,8 +14,47 @@ import pywikibot
 
 from pywikibot import pagegenerators
 from pywikibot.bot import SingleSiteBot, ExistingPageBot
+from pywikibot.comms import http
+from pywikibot.tools.itertools import itergroup
+from pywikibot.tools.threading import ThreadedGenerator
 
 from custome_fixes import all_fixes
+from tools import common_prefix, iter_dump_pages
+
+
+def load_fixes(options, do_all=False):
+    '''Create demanded fixes, their options are removed from options.'''
+    fixes = []
+    for fix, cls in all_fixes.items():
+        if do_all:
+            demand = fix not in options
+            options.pop(fix, None)
+        else:
+            demand = bool(options.pop(fix, False))
+        if demand:
+            fix_options = {}
+            for opt in cls.options.keys():
+                if opt in options:
+                    fix_options[opt] = options.pop(opt)
+            fixes.append(cls(**fix_options))
+
+    fixes.sort(key=lambda fix: fix.order)
+    return fixes
+
+
+def gate_fixes(page, fixes):
+    '''
+    Yield each fix together with whether it may apply to the page.
+
+    The fix is expected to be applied before the next one is yielded,
+    the text is lowercased only when a fix changed it.
+    '''
+    text = None
+    for fix in fixes:
+        if page.text is not text:
+            text = page.text
+            lowered = text.lower()
+        yield fix, fix.may_apply(page, lowered)
 
 
 class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
@@ -21,25 +68,30 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
 
     You can enable each fix by using its name as a command line argument
     or all fixes using -all (then, each used fix is excluded).
+
+    Supported parameters:
+    * -asynchronous - save pages in the background, processing the next
+      page meanwhile
+    * -prefetch:# - load up to # pages in the background while processing
+
+    With -dump:, fixes are applied to pages from a local dump and nothing
+    is saved, only statistics of each fix are shown:
+    * -chunksize:# - how many pages to send to a worker at once
+    * -diffs: - file to store diffs in (compressed if it ends with .gz)
+    * -stats: - file to store the statistics in as JSON
+    * -workers:# - number of processes (default all cores)
     '''
 
     def __init__(self, **kwargs):
+        self.available_options.update({
+            'asynchronous': False,
+            'prefetch': 0,
+        })
         do_all = kwargs.pop('all', False) is True
-        self.fixes = []
-        for fix, cls in all_fixes.items():
-            if do_all:
-                demand = fix not in kwargs
-                kwargs.pop(fix, None)
-            else:
-                demand = bool(kwargs.pop(fix, False))
-            if demand:
-                options = {}
-                for opt in cls.options.keys():
-                    if opt in kwargs:
-                        options[opt] = kwargs.pop(opt)
-                self.fixes.append(cls(**options))
-
-        self.fixes.sort(key=lambda fix: fix.order)
+        self.fixes = load_fixes(kwargs, do_all)
+        self.fixes_run = Counter()
+        self.fixes_skipped = Counter()
+        self._prefetcher = None
 
         super().__init__(**kwargs)
         for fix in self.fixes:
@@ -49,6 +101,17 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
             self.generator = pagegenerators.PreloadingGenerator(
                 chain.from_iterable(map(methodcaller('generator'), self.fixes)))
 
+    def setup(self):
+        super().setup()
+        if self.opt['prefetch']:
+            # fixes are applied in this thread, they share caches and the GIL
+            # would not let them run in parallel anyway
+            # run() wraps the generator, so keep the thread to stop it
+            self._prefetcher = ThreadedGenerator(
+                target=iter, args=(self.generator,),
+                qsize=self.opt['prefetch'])
+            self.generator = self._prefetcher
+
     def treat_page(self):
         summaries = []
         page = self.current_page
@@ -62,14 +125,30 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
         callback = lambda _, exc: [cb() for cb in callbacks if not exc]
         # todo: put_current
         self._save_page(page, page.save, callback=callback,
-                        summary='; '.join(summaries))
+                        summary='; '.join(summaries),
+                        asynchronous=self.opt['asynchronous'])
 
     def applyFixes(self, page, summaries=[]):
         callbacks = []
-        for fix in self.fixes:
-            fix.apply(page, summaries, callbacks)
+        for fix, applies in gate_fixes(page, self.fixes):
+            if applies:
+                self.fixes_run[fix.key] += 1
+                fix.apply(page, summaries, callbacks)
+            else:
+                self.fixes_skipped[fix.key] += 1
         return callbacks
 
+    def teardown(self):
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+        if self.fixes:
+            pywikibot.info('\nFixes run/skipped:')
+            for fix in self.fixes:
+                pywikibot.info(f'{fix.key}: {self.fixes_run[fix.key]}/'
+                               f'{self.fixes_skipped[fix.key]}')
+                fix.teardown()
+        super().teardown()
+
     def userPut(self, page, oldtext, newtext, **kwargs):
         if oldtext.rstrip() == newtext.rstrip():
             pywikibot.info(
@@ -94,12 +173,129 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
         callbacks = self.applyFixes(page, summaries)
 
         kwargs['summary'] = '; '.join(summaries)
+        kwargs.setdefault('asynchronous', self.opt['asynchronous'])
         # todo: method
         kwargs['callback'] = lambda _, exc: [cb() for cb in callbacks
                                              if not exc]
         page.save(*args, **kwargs)
 
 
+def changed_bytes(old, new):
+    '''Return the length of the changed part of the text in bytes.'''
+    old, new = old.encode(), new.encode()
+    start = common_prefix(old, new)
+    end = common_prefix(old[start:][::-1], new[start:][::-1])
+    return max(len(old), len(new)) - start - end
+
+
+_dry_run = {}
+
+
+def _init_dry_run(sitename, options, do_all, diffs):
+    site = pywikibot.Site(*sitename)
+    fixes = load_fixes(dict(options), do_all)
+    for fix in fixes:
+        fix.site = site
+        # no questions to the user
+        if hasattr(fix, 'onlypiped'):
+            fix.onlypiped = True
+        # workers cannot start processes of their own
+        if hasattr(fix, 'sandbox'):
+            fix.sandbox = None
+    _dry_run.update(site=site, fixes=fixes, diffs=diffs)
+
+
+def _init_dry_run_worker(*args):
+    if _dry_run:
+        # forked with the fixes loaded, only connections are not shared
+        http.session.close()
+    else:
+        _init_dry_run(*args)
+
+
+def _dry_run_chunk(chunk):
+    site, fixes = _dry_run['site'], _dry_run['fixes']
+    # pages, touched, bytes changed, seconds
+    stats = {fix.key: [0, 0, 0, 0.0] for fix in fixes}
+    diffs = []
+    for title, text in chunk:
+        page = pywikibot.Page(site, title)
+        page.text = text
+        summaries = []
+        for fix, applies in gate_fixes(page, fixes):
+            if not applies:
+                continue
+            old_text = page.text
+            start = time.perf_counter()
+            try:
+                fix.apply(page, summaries, [])
+            except Exception as exc:
+                pywikibot.error(f'{fix.key} failed on {title}: {exc!r}')
+                page.text = old_text
+            entry = stats[fix.key]
+            entry[0] += 1
+            entry[3] += time.perf_counter() - start
+            if page.text != old_text:
+                entry[1] += 1
+                entry[2] += changed_bytes(old_text, page.text)
+        if _dry_run['diffs'] and page.text != text:
+            diffs.append(''.join(difflib.unified_diff(
+                text.splitlines(True), page.text.splitlines(True),
+                title, f'{title} ({"; ".join(summaries)})')))
+    return stats, diffs
+
+
+def dry_run(site, dump, options, *, do_all=False, workers=0, chunksize=50,
+            diffs=None):
+    '''
+    Apply fixes demanded by options to pages from the dump without saving
+    anything.
+
+    Return the number of pages and statistics of each fix: pages it was
+    run on, pages it changed, bytes it changed and seconds it took.
+    '''
+    # workers which are not forked load the fixes on their own
+    args = ((site.code, site.family.name), options, do_all, bool(diffs))
+    _init_dry_run(*args)
+    workers = workers or os.cpu_count()
+    totals = {fix.key: [0, 0, 0, 0.0] for fix in _dry_run['fixes']}
+    pages = 0
+    pending = deque()
+    entries = ((entry.title, entry.text)
+               for entry in iter_dump_pages(dump, namespaces=[0]))
+    opener = gzip.open if diffs and diffs.endswith('.gz') else open
+    archive = opener(diffs, 'wt', encoding='utf-8') if diffs else None
+
+    def merge(result):
+        stats, page_diffs = result
+        for key, values in stats.items():
+            totals[key] = [a + b for a, b in zip(totals[key], values)]
+        for diff in page_diffs:
+            archive.write(diff)
+
+    try:
+        with multiprocessing.Pool(
+                workers, _init_dry_run_worker, args) as pool:
+            for chunk in itergroup(entries, chunksize):
+                pages += len(chunk)
+                pending.append(pool.apply_async(_dry_run_chunk, (chunk,)))
+                while len(pending) >= 2 * workers:
+                    merge(pending.popleft().get())
+            while pending:
+                merge(pending.popleft().get())
+    finally:
+        if archive is not None:
+            archive.close()
+    return totals, pages
+
+
+def report_dry_run(totals, pages):
+    pywikibot.info(f'\n{pages} pages')
+    pywikibot.info('fix: run on pages, changed pages, changed bytes, time')
+    for key, (run, touched, changed, seconds) in totals.items():
+        pywikibot.info(f'{key}: {run}, {touched}, {changed}, {seconds:.1f}s')
+
+
 def main(*args):
     options = {}
     local_args = pywikibot.handle_args(args)
@@ -112,6 +308,27 @@ def main(*args):
             else:
                 options[arg[1:]] = True
 
+    if 'dump' in options:
+        # dry run, see dry_run
+        dump = options.pop('dump')
+        workers = options.pop('workers', 0)
+        chunksize = options.pop('chunksize', 50)
+        diffs = options.pop('diffs', None)
+        stats_file = options.pop('stats', None)
+        do_all = options.pop('all', False) is True
+        start = time.perf_counter()
+        totals, pages = dry_run(pywikibot.Site(), dump, options,
+                                do_all=do_all, workers=workers,
+                                chunksize=chunksize, diffs=diffs)
+        report_dry_run(totals, pages)
+        pywikibot.info(f'Finished in {time.perf_counter() - start:.1f}s')
+        if stats_file:
+            with open(stats_file, 'w', encoding='utf-8') as f:
+                json.dump({key: dict(zip(
+                    ('pages', 'touched', 'bytes', 'time'), values))
+                    for key, values in totals.items()}, f, indent=1)
+        return
+
     generator = genFactory.getCombinedGenerator(preload=True)
     bot = WikitextFixingBot(generator=generator, **options)
     bot.run()